@@ -1,8 +1,108 @@
-chrome.storage.session.setAccessLevel({ accessLevel: 'TRUSTED_AND_UNTRUSTED_CONTEXTS' });
+const SERVER_URL = 'https://instructional-ct-teams-safe.trycloudflare.com';
+const BATCH_WINDOW_MS = 15;   // How long a prediction waits for others from any tab
+const BATCH_MAX_ITEMS = 16;   // Ship the batch early once this many are waiting
+const PREDICT_TIMEOUT_MS = 15000; // Give up on a prediction request after this long
+const RETRY_AFTER_MS = 2000;  // Suggested retry delay when the server is unreachable or too slow
+
+const DEFAULT_SERVER_CONFIG = { model_input_size: 640, min_image_side: 128 };
+
+let serverConfigPromise = null;
+let pendingPredictions = [];
+let flushTimer = null;
+
+// Buffers predictions from all tabs and sends them to /predict_binary together,
+// so one tunnel round-trip is shared by every image queued in the window.
+// Content scripts can only pass JSON to the worker, so images arrive as JPEG data
+// URLs and are unpacked here into binary multipart parts for the wire.
+function queuePrediction(body, sendResponse) {
+    pendingPredictions.push({ body, sendResponse });
+    if (pendingPredictions.length >= BATCH_MAX_ITEMS) {
+        flushPredictions();
+    } else if (!flushTimer) {
+        flushTimer = setTimeout(flushPredictions, BATCH_WINDOW_MS);
+    }
+}
+
+function flushPredictions() {
+    clearTimeout(flushTimer);
+    flushTimer = null;
+    const batch = pendingPredictions;
+    pendingPredictions = [];
+    if (batch.length === 0) return;
+
+    const form = new FormData();
+    const meta = batch.map((entry, i) => {
+        const { base64_image, ...fields } = entry.body;
+        form.append(`image_${i}`, dataUrlToBlob(base64_image || ''), `image_${i}`);
+        return fields;
+    });
+    form.append('meta', JSON.stringify(meta));
+
+    fetchWithTimeout(`${SERVER_URL}/predict_binary`, { method: 'POST', body: form })
+    .then(response => response.json())
+    .then(data => {
+        if (data.prediction === 'UNKNOWN') {
+            // Shed by the server under load: every image is to be retried later
+            batch.forEach(entry => entry.sendResponse(data));
+            return;
+        }
+        if (!Array.isArray(data.results)) {
+            throw new Error(data.error || 'Malformed batch response');
+        }
+        batch.forEach((entry, i) => entry.sendResponse(data.results[i] || { error: 'Missing batch result' }));
+    })
+    .catch(error => batch.forEach(entry => entry.sendResponse(failedPrediction(error))));
+}
+
+// Aborts the request once PREDICT_TIMEOUT_MS pass, so a stalled server never leaves
+// images waiting forever
+function fetchWithTimeout(url, options) {
+    const controller = new AbortController();
+    const timer = setTimeout(() => controller.abort(), PREDICT_TIMEOUT_MS);
+    return fetch(url, { ...options, signal: controller.signal }).finally(() => clearTimeout(timer));
+}
+
+// A timed-out request is reported like a shed one, as UNKNOWN to retry; anything else is an error
+function failedPrediction(error) {
+    if (error.name === 'AbortError') {
+        return { prediction: 'UNKNOWN', error: 'timeout', retry_after_ms: RETRY_AFTER_MS };
+    }
+    return { error: error.message };
+}
+
+// Fetched once per worker lifetime; falls back to defaults if the server is unreachable
+function getServerConfig() {
+    if (!serverConfigPromise) {
+        serverConfigPromise = fetch(`${SERVER_URL}/config`)
+            .then(response => response.json())
+            .then(config => ({ ...DEFAULT_SERVER_CONFIG, ...config }))
+            .catch(error => {
+                console.error("Error fetching server config:", error);
+                serverConfigPromise = null;
+                return DEFAULT_SERVER_CONFIG;
+            });
+    }
+    return serverConfigPromise;
+}
+
+function dataUrlToBlob(dataUrl) {
+    const comma = dataUrl.indexOf(',');
+    const mimeMatch = dataUrl.slice(0, comma).match(/^data:([^;,]+)/);
+    const binary = atob(dataUrl.slice(comma + 1));
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return new Blob([bytes], { type: mimeMatch ? mimeMatch[1] : 'application/octet-stream' });
+}
 
 chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
     if (request.action === 'predict') {
-        fetch('https://instructional-ct-teams-safe.trycloudflare.com/predict', {
+        queuePrediction(request.body, sendResponse);
+        return true; // This is crucial for async sendResponse
+    }
+    else if (request.action === 'registerSession') {
+        fetch(`${SERVER_URL}/session`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify(request.body)
@@ -10,8 +110,24 @@ chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
         .then(response => response.json())
         .then(data => sendResponse(data))
         .catch(error => sendResponse({ error: error.message }));
-        
-        return true; // This is crucial for async sendResponse
+        return true;
+    }
+    else if (request.action === 'predictFrame') {
+        // Video frames are sent one at a time as they are sampled; batching would delay the blur
+        const { base64_image, ...fields } = request.body;
+        fetchWithTimeout(`${SERVER_URL}/predict_stream`, {
+            method: 'POST',
+            headers: { 'X-Predict-Meta': JSON.stringify(fields) },
+            body: dataUrlToBlob(base64_image || '')
+        })
+        .then(response => response.json())
+        .then(data => sendResponse(data))
+        .catch(error => sendResponse(failedPrediction(error)));
+        return true;
+    }
+    else if (request.action === 'getConfig') {
+        getServerConfig().then(sendResponse);
+        return true;
     }
     
     // For all other synchronous actions, we don't need to return anything.
@@ -37,17 +153,6 @@ chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
             chrome.storage.local.set({ memoryUsageBySite });
         });
     }
-    else if (request.action === "escalateSite") {
-        const siteToEscalate = request.siteUrl;
-        console.log(`Escalating site to high-risk: ${siteToEscalate}`);
-        chrome.storage.session.get(['highRiskSites'], (data) => {
-            const sites = data.highRiskSites || [];
-            if (!sites.includes(siteToEscalate)) {
-                sites.push(siteToEscalate);
-                chrome.storage.session.set({ highRiskSites: sites });
-            }
-        });
-    }
     else if (request.action === "logFirstProcessingTime") {
         chrome.storage.local.get('firstProcessingTimes', (data) => {
             let firstProcessingTimes = data.firstProcessingTimes || {};
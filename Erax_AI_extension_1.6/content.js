@@ -1,4 +1,9 @@
 const processedImages = new Map();
+const pendingVerdicts = new Map(); // signature -> promise of the verdict for an image being classified
+const UPLOAD_IMAGE_TYPE = 'image/jpeg'; // Much smaller than PNG; the server decodes it straight to RGB
+const UPLOAD_IMAGE_QUALITY = 0.85;
+const REGION_PADDING = 0.15;       // Each flagged region grows by this share of its size on every side
+const REGION_FULL_BLUR_AREA = 0.5; // Blur the whole element once the regions cover more of it than this
 
 function getImageSignature(img) {
     return img.src || img.dataset.src || '';
@@ -6,6 +11,77 @@ function getImageSignature(img) {
 
 let observer;
 
+// Viewport-priority scheduling: visible media first, then media within a screen of
+// the viewport, and off-screen media trickling through one at a time.
+const MAX_IN_FLIGHT = 6;
+const MAX_OFFSCREEN_IN_FLIGHT = 1;
+const NEAR_VIEWPORT_MARGIN = '100% 0px';
+const PRIORITY_VISIBLE = 0;
+const PRIORITY_NEAR = 1;
+const PRIORITY_OFFSCREEN = 2;
+const mediaQueues = [new Set(), new Set(), new Set()];
+const queuedPriority = new Map();
+const viewportState = new WeakMap(); // element -> { visible, near }
+let inFlight = 0;
+let visibleObserver;
+let nearObserver;
+
+// Video mode: frames are sampled every VIDEO_MIN_INTERVAL_MS while the picture changes,
+// backing off towards VIDEO_MAX_INTERVAL_MS while it does not. A frame is only sent
+// when its VIDEO_DIFF_SIZE grayscale thumbnail differs from the last sent one by more
+// than VIDEO_DIFF_THRESHOLD (mean absolute difference, 0-255).
+const VIDEO_MIN_INTERVAL_MS = 500;
+const VIDEO_MAX_INTERVAL_MS = 4000;
+const VIDEO_DIFF_SIZE = 32;
+const VIDEO_DIFF_THRESHOLD = 8;
+const MAX_PREDICT_RETRIES = 3; // Times an image answered UNKNOWN (server busy or slow) is queued again
+let serverConfigPromise = null;
+let pageSession = null; // { key, promise } for the registered page context
+
+function getServerConfig() {
+    if (!serverConfigPromise) {
+        serverConfigPromise = chrome.runtime.sendMessage({ action: 'getConfig' })
+            .catch(() => ({ model_input_size: 640, min_image_side: 128 }));
+    }
+    return serverConfigPromise;
+}
+
+// Scales (width, height) so the longest side is at most the model input size;
+// the model would letterbox it down to that anyway. Very tall or very large images,
+// which the server tiles, go up at up to the tile size on their short side instead
+// so small regions survive; pass tiled = false where that is not wanted.
+function getUploadSize(width, height, config, tiled = true) {
+    let scale = Math.min(1, config.model_input_size / Math.max(width, height));
+    if (tiled && config.tile_trigger_side && Math.max(width, height) > config.tile_trigger_side) {
+        scale = Math.min(1, config.tile_upload_side / Math.min(width, height), config.max_upload_side / Math.max(width, height));
+    }
+    return [Math.max(1, Math.round(width * scale)), Math.max(1, Math.round(height * scale))];
+}
+
+// Registers the page context (site, title) with the server once and reuses the
+// session id for every image; a new session is made when either of them changes.
+// Escalation to high-risk is tracked per domain by the server itself.
+function getPageSession() {
+    const sourceUrl = window.location.hostname;
+    const key = `${sourceUrl}\n${document.title}`;
+    if (!pageSession || pageSession.key !== key) {
+        const promise = chrome.runtime.sendMessage({
+            action: 'registerSession',
+            body: { source_url: sourceUrl, page_title: document.title }
+        }).then(response => {
+            if (!response || response.error) {
+                throw new Error(response ? response.error : 'No response registering page session');
+            }
+            return response.session_id;
+        });
+        pageSession = { key, promise };
+        promise.catch(() => {
+            if (pageSession && pageSession.promise === promise) pageSession = null;
+        });
+    }
+    return pageSession.promise;
+}
+
 function updateSiteBlurStats() {
     const currentSite = window.location.hostname;
     chrome.storage.local.get(['blurStatsBySite'], (data) => {
@@ -19,13 +95,14 @@ function incrementBlurStats() {
     updateSiteBlurStats();
 }
 
-async function makeRequest(body) {
+async function makeRequest(body, action = 'predict') {
     try {
-        const response = await chrome.runtime.sendMessage({ action: 'predict', body: body });
+        const response = await chrome.runtime.sendMessage({ action: action, body: body });
         if (chrome.runtime.lastError) {
              throw new Error(chrome.runtime.lastError.message);
         }
-        if (response.error) {
+        // UNKNOWN carries the reason in 'error' but is an answer: retry later
+        if (response.error && response.prediction !== 'UNKNOWN') {
             throw new Error(response.error);
         }
         return response;
@@ -35,6 +112,165 @@ async function makeRequest(body) {
     }
 }
 
+// Sends one request under the page session, registering the page again once if the
+// server has expired it.
+async function requestWithSession(body, action = 'predict') {
+    for (let attempt = 0; ; attempt++) {
+        const sessionId = await getPageSession();
+        try {
+            return await makeRequest({ ...body, session_id: sessionId }, action);
+        } catch (error) {
+            if (error.message !== 'session_expired' || attempt > 0) throw error;
+            pageSession = null;
+        }
+    }
+}
+
+function classifyImage(imageDataUrl, altText) {
+    return requestWithSession({ base64_image: imageDataUrl, alt_text: altText, caption: "" });
+}
+
+// Puts an element answered UNKNOWN back in the queue after the server's suggested delay,
+// growing with each attempt
+function retryLater(element, retryAfterMs) {
+    const retries = Number(element.dataset.nsfwRetries || 0);
+    if (retries >= MAX_PREDICT_RETRIES) return;
+    element.dataset.nsfwRetries = String(retries + 1);
+    delete element.dataset.nsfwProcessed;
+    setTimeout(() => scheduleMediaElement(element), (retryAfterMs || 1000) * (retries + 1));
+}
+
+function setBlur(element, blurred) {
+    element.style.filter = blurred ? 'blur(20px)' : '';
+    element.style.webkitFilter = blurred ? 'blur(20px)' : '';
+}
+
+// Blurs only the flagged regions of an image with backdrop-filter patches on an overlay
+// laid over it, each patch on its own compositing layer so scrolling never re-blurs.
+// Patches are placed in percentages, so the overlay only has to track the element's box.
+function showRegionOverlay(element, regions, scale) {
+    if (element.dataset.nsfwOverlay === "true") return;
+    element.dataset.nsfwOverlay = "true";
+    const overlay = document.createElement('div');
+    overlay.className = 'nsfw-region-overlay';
+    Object.assign(overlay.style, { position: 'absolute', pointerEvents: 'none', overflow: 'hidden', zIndex: 2147483646 });
+    for (const [x1, y1, x2, y2] of regions) {
+        const padX = (x2 - x1) * REGION_PADDING;
+        const padY = (y2 - y1) * REGION_PADDING;
+        const left = Math.max(0, x1 - padX) / scale;
+        const top = Math.max(0, y1 - padY) / scale;
+        const right = Math.min(scale, x2 + padX) / scale;
+        const bottom = Math.min(scale, y2 + padY) / scale;
+        const patch = document.createElement('div');
+        Object.assign(patch.style, {
+            position: 'absolute',
+            left: `${left * 100}%`, top: `${top * 100}%`,
+            width: `${(right - left) * 100}%`, height: `${(bottom - top) * 100}%`,
+            backdropFilter: 'blur(20px)', webkitBackdropFilter: 'blur(20px)',
+            willChange: 'transform'
+        });
+        overlay.appendChild(patch);
+    }
+    // A sibling shares the element's offsetParent, so its offsets place the overlay exactly
+    const place = () => {
+        overlay.style.left = `${element.offsetLeft + element.clientLeft}px`;
+        overlay.style.top = `${element.offsetTop + element.clientTop}px`;
+        overlay.style.width = `${element.clientWidth}px`;
+        overlay.style.height = `${element.clientHeight}px`;
+    };
+    element.insertAdjacentElement('afterend', overlay);
+    place();
+    new ResizeObserver(place).observe(element);
+}
+
+// Region blur when the server returned usable boxes, whole-element blur otherwise
+function applyNsfwVerdict(element, verdict) {
+    const regions = verdict.regions || [];
+    const scale = verdict.region_scale;
+    const area = regions.reduce((sum, [x1, y1, x2, y2]) => sum + (x2 - x1) * (y2 - y1), 0) / (scale * scale);
+    if (regions.length === 0 || !scale || area > REGION_FULL_BLUR_AREA || element.tagName !== 'IMG') {
+        setBlur(element, true);
+    } else {
+        showRegionOverlay(element, regions, scale);
+    }
+}
+
+// Grayscale VIDEO_DIFF_SIZE x VIDEO_DIFF_SIZE thumbnail of the current frame
+function sampleFrameSignature(video, ctx) {
+    ctx.drawImage(video, 0, 0, VIDEO_DIFF_SIZE, VIDEO_DIFF_SIZE);
+    const { data } = ctx.getImageData(0, 0, VIDEO_DIFF_SIZE, VIDEO_DIFF_SIZE);
+    const gray = new Uint8Array(VIDEO_DIFF_SIZE * VIDEO_DIFF_SIZE);
+    for (let i = 0; i < gray.length; i++) {
+        gray[i] = (data[i * 4] * 77 + data[i * 4 + 1] * 150 + data[i * 4 + 2] * 29) >> 8;
+    }
+    return gray;
+}
+
+function frameDifference(a, b) {
+    let total = 0;
+    for (let i = 0; i < a.length; i++) {
+        total += Math.abs(a[i] - b[i]);
+    }
+    return total / a.length;
+}
+
+// Keeps sampling a video for as long as it stays in the page. The server smooths the
+// frame verdicts per stream and decides blur/unblur with hysteresis; this loop just
+// applies its decision and adapts how often it looks.
+function watchVideo(video, altText) {
+    const frameCanvas = document.createElement('canvas');
+    const frameCtx = frameCanvas.getContext('2d');
+    const diffCanvas = document.createElement('canvas');
+    diffCanvas.width = diffCanvas.height = VIDEO_DIFF_SIZE;
+    const diffCtx = diffCanvas.getContext('2d', { willReadFrequently: true });
+    let streamId = null;
+    let lastSent = null;
+    let interval = VIDEO_MIN_INTERVAL_MS;
+
+    const sample = async () => {
+        if (!video.isConnected) return;
+        try {
+            if (!video.paused && !video.ended && !document.hidden && video.readyState >= 2) {
+                const signature = sampleFrameSignature(video, diffCtx);
+                if (lastSent && frameDifference(signature, lastSent) < VIDEO_DIFF_THRESHOLD) {
+                    interval = Math.min(interval * 2, VIDEO_MAX_INTERVAL_MS);
+                } else {
+                    const config = await getServerConfig();
+                    [frameCanvas.width, frameCanvas.height] = getUploadSize(video.videoWidth, video.videoHeight, config, false);
+                    frameCtx.drawImage(video, 0, 0, frameCanvas.width, frameCanvas.height);
+                    const result = await requestWithSession({
+                        base64_image: frameCanvas.toDataURL(UPLOAD_IMAGE_TYPE, UPLOAD_IMAGE_QUALITY),
+                        stream_id: streamId,
+                        alt_text: altText,
+                        caption: ""
+                    }, 'predictFrame');
+                    if (result.prediction === 'UNKNOWN') {
+                        // Server busy: keep the current decision and look again later
+                        interval = Math.max(interval, result.retry_after_ms || VIDEO_MAX_INTERVAL_MS);
+                        setTimeout(sample, interval);
+                        return;
+                    }
+                    lastSent = signature;
+                    streamId = result.stream_id;
+                    setBlur(video, result.blur);
+                    if (result.changed && result.blur) incrementBlurStats();
+                    interval = result.changed ? VIDEO_MIN_INTERVAL_MS : Math.min(interval * 2, VIDEO_MAX_INTERVAL_MS);
+                }
+            }
+        } catch (error) {
+            // Cross-origin frames taint the canvas for good; there is nothing more to sample
+            if (error.name === 'SecurityError') return;
+            console.error("Error sampling video frame:", error);
+            interval = VIDEO_MAX_INTERVAL_MS;
+        }
+        setTimeout(sample, interval);
+    };
+    // A change in what is playing starts from a fresh comparison at the fast rate
+    video.addEventListener('seeked', () => { lastSent = null; interval = VIDEO_MIN_INTERVAL_MS; });
+    video.addEventListener('play', () => { interval = VIDEO_MIN_INTERVAL_MS; });
+    return sample();
+}
+
 async function processMediaElement(element) {
     if (!element || element.dataset.nsfwProcessed === "true" || !element.isConnected) return;
 
@@ -47,85 +283,161 @@ async function processMediaElement(element) {
 
     const imageSignature = getImageSignature(element);
     if (processedImages.has(imageSignature)) {
-        if (processedImages.get(imageSignature) === "NSFW") {
-            element.style.filter = 'blur(20px)';
-            element.style.webkitFilter = 'blur(20px)';
+        const verdict = processedImages.get(imageSignature);
+        if (verdict.prediction === "NSFW") {
+            applyNsfwVerdict(element, verdict);
         }
         return;
     }
     
+    // Another copy of this image is being classified right now: share its answer
+    const pending = imageSignature && pendingVerdicts.get(imageSignature);
+    if (pending) {
+        element.dataset.nsfwProcessed = "true";
+        const verdict = await pending;
+        if (verdict && verdict.prediction === "NSFW") {
+            applyNsfwVerdict(element, verdict);
+        } else if (verdict && verdict.prediction === "UNKNOWN") {
+            retryLater(element, verdict.retry_after_ms);
+        }
+        return;
+    }
+
     element.dataset.nsfwProcessed = "true";
 
-    let imageDataUrl;
+    // Images register a promise for their verdict so concurrent copies wait on it;
+    // it settles with null when no verdict came back
+    let verdict = null;
+    let settleVerdict = null;
+    if (imageSignature && element.tagName === 'IMG') {
+        pendingVerdicts.set(imageSignature, new Promise(resolve => { settleVerdict = resolve; }));
+    }
     try {
-        const canvas = document.createElement('canvas');
-        const ctx = canvas.getContext('2d');
-        element.crossOrigin = "anonymous";
-
-        if (element.tagName === 'IMG') {
-            if (!element.complete) await new Promise(r => { element.onload = r; element.onerror = r; });
-            canvas.width = element.naturalWidth;
-            canvas.height = element.naturalHeight;
-            if (canvas.width < 128 || canvas.height < 128) return;
-            ctx.drawImage(element, 0, 0);
-        } else if (element.tagName === 'VIDEO') {
-            if (element.readyState < 2) await new Promise(r => { element.onloadeddata = r; element.onerror = r; });
-            canvas.width = element.videoWidth;
-            canvas.height = element.videoHeight;
-            if (canvas.width < 128 || canvas.height < 128) return;
+        let imageDataUrl;
+        try {
+            const config = await getServerConfig();
+            const canvas = document.createElement('canvas');
+            const ctx = canvas.getContext('2d');
+            element.crossOrigin = "anonymous";
+
+            let sourceWidth, sourceHeight;
+            if (element.tagName === 'IMG') {
+                if (!element.complete) await new Promise(r => { element.onload = r; element.onerror = r; });
+                sourceWidth = element.naturalWidth;
+                sourceHeight = element.naturalHeight;
+            } else if (element.tagName === 'VIDEO') {
+                if (element.readyState < 2) await new Promise(r => { element.onloadeddata = r; element.onerror = r; });
+                if (element.videoWidth < config.min_image_side || element.videoHeight < config.min_image_side) return;
+                // Videos are sampled for as long as they play rather than judged on one frame
+                return watchVideo(element, (element.alt || "").toLowerCase());
+            } else {
+                 return;
+            }
+            if (sourceWidth < config.min_image_side || sourceHeight < config.min_image_side) return;
+            [canvas.width, canvas.height] = getUploadSize(sourceWidth, sourceHeight, config);
+            ctx.imageSmoothingQuality = 'high'; // Resizing the canvas resets context state, so set it afterwards
             ctx.drawImage(element, 0, 0, canvas.width, canvas.height);
-        } else {
-             return;
+            imageDataUrl = canvas.toDataURL(UPLOAD_IMAGE_TYPE, UPLOAD_IMAGE_QUALITY);
+        } catch (e) {
+            return;
+        }
+
+        try {
+            const elementAltText = (element.alt || "").toLowerCase();
+
+            // The server applies the lower threshold itself once it has escalated this domain
+            const result = await classifyImage(imageDataUrl, elementAltText);
+            if (result.prediction === "UNKNOWN") {
+                verdict = result;
+                retryLater(element, result.retry_after_ms);
+                return;
+            }
+
+            verdict = { prediction: result.prediction, regions: result.regions, region_scale: result.region_scale };
+            processedImages.set(imageSignature, verdict);
+
+            if (result.prediction === "NSFW") {
+                applyNsfwVerdict(element, result);
+                incrementBlurStats();
+            }
+        } catch (error) {
+            console.error("Error processing element:", error);
+        }
+    } finally {
+        if (settleVerdict) {
+            pendingVerdicts.delete(imageSignature);
+            settleVerdict(verdict);
         }
-        imageDataUrl = canvas.toDataURL('image/png');
-    } catch (e) {
-        return;
     }
+}
 
-    try {
-        const currentSite = window.location.hostname;
-        const elementAltText = (element.alt || "").toLowerCase();
-
-        // #new code - This logic now only prepares the flag to be sent to the backend
-        const getStorageData = (keys) => new Promise(resolve => chrome.storage.session.get(keys, resolve));
-        const storageData = await getStorageData(['highRiskSites']);
-        const isHighRisk = (storageData.highRiskSites || []).includes(currentSite);
-
-        const requestBody = {
-            base64_image: imageDataUrl,
-            source_url: currentSite,
-            page_title: document.title,
-            alt_text: elementAltText,
-            caption: "",
-            use_low_threshold: isHighRisk // This flag tells the backend to use a lower threshold
-        };
-        
-        const result = await makeRequest(requestBody);
-
-        if (result.escalate === true) {
-            chrome.runtime.sendMessage({ action: "escalateSite", siteUrl: currentSite });
+function createViewportObservers() {
+    const update = (key) => (entries) => {
+        for (const entry of entries) {
+            const state = viewportState.get(entry.target) || { visible: false, near: false };
+            state[key] = entry.isIntersecting;
+            viewportState.set(entry.target, state);
+            if (queuedPriority.has(entry.target)) {
+                const priority = state.visible ? PRIORITY_VISIBLE : state.near ? PRIORITY_NEAR : PRIORITY_OFFSCREEN;
+                setMediaPriority(entry.target, priority);
+            }
         }
+        pumpMediaQueue();
+    };
+    visibleObserver = new IntersectionObserver(update('visible'));
+    nearObserver = new IntersectionObserver(update('near'), { rootMargin: NEAR_VIEWPORT_MARGIN });
+}
+
+function scheduleMediaElement(element) {
+    if (!element || element.dataset.nsfwProcessed === "true" || queuedPriority.has(element)) return;
+    // Off-screen until the observers report otherwise (they fire once right after observe)
+    setMediaPriority(element, PRIORITY_OFFSCREEN);
+    visibleObserver.observe(element);
+    nearObserver.observe(element);
+    pumpMediaQueue();
+}
 
-        processedImages.set(imageSignature, result.prediction);
+function setMediaPriority(element, priority) {
+    const current = queuedPriority.get(element);
+    if (current !== undefined) mediaQueues[current].delete(element);
+    queuedPriority.set(element, priority);
+    mediaQueues[priority].add(element);
+}
 
-        if (result.prediction === "NSFW") {
-            element.style.filter = 'blur(20px)';
-            element.style.webkitFilter = 'blur(20px)';
-            incrementBlurStats();
+function takeNextMediaElement() {
+    for (let priority = PRIORITY_VISIBLE; priority <= PRIORITY_OFFSCREEN; priority++) {
+        if (priority === PRIORITY_OFFSCREEN && inFlight >= MAX_OFFSCREEN_IN_FLIGHT) return null;
+        const next = mediaQueues[priority].values().next();
+        if (!next.done) {
+            mediaQueues[priority].delete(next.value);
+            queuedPriority.delete(next.value);
+            visibleObserver.unobserve(next.value);
+            nearObserver.unobserve(next.value);
+            return next.value;
         }
-    } catch (error) {
-        console.error("Error processing element:", error);
     }
+    return null;
 }
 
+function pumpMediaQueue() {
+    while (inFlight < MAX_IN_FLIGHT) {
+        const element = takeNextMediaElement();
+        if (!element) return;
+        inFlight++;
+        processMediaElement(element).finally(() => {
+            inFlight--;
+            pumpMediaQueue();
+        });
+    }
+}
 
-async function traverseShadowDOM(root) {
+function traverseShadowDOM(root) {
     if (!root) return;
     const nodes = root.querySelectorAll('img, video');
     for (const node of nodes) {
-        await processMediaElement(node);
+        scheduleMediaElement(node);
         if (node.shadowRoot) {
-            await traverseShadowDOM(node.shadowRoot);
+            traverseShadowDOM(node.shadowRoot);
         }
     }
 }
@@ -136,11 +448,11 @@ function observeMedia() {
             for (const node of mutation.addedNodes) {
                 if (node.nodeType === 1) { 
                     if (node.matches('img, video')) {
-                        processMediaElement(node);
+                        scheduleMediaElement(node);
                     }
                     const mediaElements = node.querySelectorAll('img, video');
                     for (const media of mediaElements) {
-                        processMediaElement(media);
+                        scheduleMediaElement(media);
                     }
                 }
             }
@@ -163,11 +475,15 @@ window.onload = () => {
         });
     }, 500);
 
+    createViewportObservers();
     traverseShadowDOM(document.body);
     observeMedia();
 };
 
 window.addEventListener('unload', () => {
     if (observer) observer.disconnect();
+    if (visibleObserver) visibleObserver.disconnect();
+    if (nearObserver) nearObserver.disconnect();
     processedImages.clear();
+    pendingVerdicts.clear();
 });
\ No newline at end of file
@@ -6,6 +6,7 @@ from io import BytesIO
 import cv2
 import numpy as np
 import os
+import errno
 import torch
 import torch_directml
 import time
@@ -13,8 +14,24 @@ import atexit
 import signal
 import sys
 import re
+import math
+import functools
+import weakref
+import hashlib
+import secrets
+import json
+import sqlite3
+import queue
+import random
+import argparse
+import asyncio
+import threading
+import multiprocessing
+import multiprocessing.connection
+from multiprocessing import shared_memory
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from statistics import mean
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
 
 # EraX Model imports
 from ultralytics import YOLO
@@ -23,18 +40,148 @@ from huggingface_hub import snapshot_download
 # +++ CONTROL FLAGS +++
 ENABLE_DOMAIN_RULES = False       # Set to False to disable URL/title-based threshold adjustments
 ENABLE_UNSAFE_WORD_CHECK = False   # Set to False to disable alt_text/caption keyword checking
+ENABLE_MICRO_BATCHING = True      # Set to False to run one forward pass per request
+BATCH_MAX_SIZE = 16               # Max images collected into one forward pass
+BATCH_MAX_WAIT_MS = 10            # Max time the first image of a batch waits for company
+PREDICT_BATCH_MAX_ITEMS = 64      # Max images accepted by one /predict_batch request
+ENABLE_VERDICT_CACHE = True       # Set to False to run the model on every repeated image
+VERDICT_CACHE_MAX_ENTRIES = 50000 # Max distinct images kept in the verdict cache
+VERDICT_CACHE_TTL_SECONDS = 6 * 3600
+ENABLE_NEAR_DUPLICATE_CACHE = True # Set to False to only reuse verdicts for byte-identical pixels
+PHASH_MAX_DISTANCE = 6            # Max Hamming distance between dHashes treated as the same picture
+PHASH_MIN_DETAIL_BITS = 8         # dHashes with fewer set (or unset) bits than this are too flat to match on
+PHASH_VERIFY_SAMPLE_RATE = 0.02   # Share of near-duplicate hits re-run through the model to measure disagreement
+INFERENCE_BACKEND = 'ultralytics'  # 'ultralytics' (PyTorch), 'onnxruntime' or 'openvino'
+ONNX_QUANTIZE_INT8 = False        # Serve a dynamically INT8-quantized copy of the ONNX export
+INFERENCE_INTRA_OP_THREADS = 0    # Threads inside one operator (0 = library default)
+INFERENCE_INTER_OP_THREADS = 0    # Parallel operators / OpenVINO streams (0 = library default)
+INFERENCE_WORKERS = 0             # Inference worker processes (0 = run the model inside the server process)
+WORKER_THREADS = 0                # Threads per worker (0 = cores divided evenly between workers)
+WORKER_SLOT_BYTES = 2048 * 2048 * 3 # Shared-memory slot size; larger images are downscaled to fit
+INFERENCE_TIMEOUT_SECONDS = 60    # Longest a request waits for its forward pass (or a free worker slot)
+ARCHIVE_QUEUE_SIZE = 256          # Images waiting to be written to the archive
+ARCHIVE_FULL_POLICY = 'drop'      # When the archive queue is full: 'drop' the image or 'block' the request
+PAGE_SESSION_TTL_SECONDS = 30 * 60 # Page sessions expire after this long without an image request
+PAGE_SESSION_MAX = 10000          # Max live page sessions kept in memory
+ESCALATION_TTL_SECONDS = 30 * 60  # An escalated domain returns to normal this long after its last trigger
+ESCALATION_MAX_DOMAINS = 10000    # Max escalated domains remembered
+ENABLE_VERDICT_STORE = True       # Set to False to keep cached verdicts in memory only
+VERDICT_STORE_WARM_ENTRIES = 20000 # Most recent stored verdicts loaded into the cache at startup
+VERDICT_STORE_MAX_AGE_SECONDS = 30 * 24 * 3600
+VERDICT_STORE_PRUNE_INTERVAL_SECONDS = 3600 # How often expired verdicts and their raw-key aliases are deleted
+ENABLE_ADAPTIVE_DOMAINS = True    # Set to False to ignore per-domain verdict history
+DOMAIN_STATS_MAX = 5000           # Domains tracked; the least recently seen are evicted beyond this
+DOMAIN_HISTOGRAM_BINS = 20        # Bins of each domain's top-NSFW-confidence histogram
+DOMAIN_RATE_ALPHA = 0.05          # Weight of the newest verdict in a domain's recent NSFW rate
+DOMAIN_MIN_SAMPLES = 20           # Verdicts needed before a domain's history changes its threshold
+DOMAIN_RISKY_RATE = 0.2           # Recent NSFW rate at which a domain is lowered all the way to UNSAFE_WORD_THRESHOLD
+DOMAIN_SKIP_CLEAN_STREAK = 500    # SFW verdicts in a row after which a domain's images may skip the model
+DOMAIN_SKIP_SAMPLE_RATE = 0.1     # Share of a skipping domain's images still sent to the model
+ENABLE_REQUEST_COALESCING = True  # Set to False to let concurrent identical images each run the model
+ENABLE_SAFE_PREFILTER = True      # Set to False to send every uncached image to the model
+PREFILTER_SIDE = 64               # Thumbnail side the skin-tone pre-filter looks at
+PREFILTER_SKIN_RATIO = 0.03       # At the default threshold, images with less skin-tone area than this skip the model
+PREFILTER_MIN_CHROMA = 6.0        # Images with less mean colour than this (grayscale, sepia) always go to the model
+ENABLE_TILED_INFERENCE = True     # Set to False to only ever run one letterboxed pass per image
+TILE_MAX_DOWNSCALE = 2.0          # Tile images the letterbox would shrink more than this; each tile shrinks at most this
+TILE_TRIGGER_DOWNSCALE = 4.0      # The extension only uploads above model size for images it would shrink more than this
+TILE_OVERLAP = 0.2                # Share of a tile's side overlapping its neighbours
+TILE_MAX_COUNT = 16               # Max tiles per image; tiles grow beyond the downscale limit to stay under it
+TILE_MAX_UPLOAD_SIDE = 4096       # Longest side the extension may upload for an image worth tiling
+TILE_NMS_IOU = 0.5                # IoU above which same-class detections from different tiles are merged
+REGION_BOX_SCALE = 1000           # Region boxes are sent as integers in [0, REGION_BOX_SCALE] of the image size
+MAX_REGIONS = 16                  # Max flagged regions returned per image
+STREAM_EMA_ALPHA = 0.5            # Weight of the newest frame in a video stream's smoothed confidence
+STREAM_UNBLUR_RATIO = 0.5         # A blurred stream clears once its smoothed confidence drops below threshold * this
+STREAM_TTL_SECONDS = 5 * 60       # Video streams are forgotten this long after their last frame
+STREAM_MAX = 5000                 # Max live video streams kept in memory
+ASGI_THREADS = 8                  # Threads running request handlers in --asgi mode
+ADMISSION_QUEUE_SIZE = 64         # Predict requests admitted at once (running + waiting) in --asgi mode; more are shed
+REQUEST_DEADLINE_MS = 5000        # Predict requests unanswered after this get an UNKNOWN verdict to retry (--asgi mode)
+SHED_RETRY_AFTER_MS = 1000        # Retry delay suggested with an UNKNOWN verdict
+MAX_REQUEST_BYTES = 64 * 1024 * 1024 # Larger request bodies are refused in --asgi mode
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # Histogram bounds in seconds
+LATENCY_WINDOW = 2048             # Recent samples per stage kept for percentiles in the statistics printout
+DECODE_POOL_BUFFERS = 16          # Model-input-sized decode buffers kept for reuse
+DECODE_POOL_LARGE_BUFFERS = 2     # Tiling-sized decode buffers kept for reuse (~50 MB each at TILE_MAX_UPLOAD_SIDE 4096)
+RECORD_REQUESTS_PATH = None       # Append every prediction request body to this JSONL file (replayed by benchmark_server.py)
 # +++++++++++++++++++++++++++++++
 
+class LatencyHistogram:
+    # Fixed-bucket latency histogram (Prometheus-style) plus a bounded window of recent
+    # samples for percentiles, so memory stays constant however long the server runs
+    def __init__(self, buckets, window):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.min = float('inf')
+        self.max = 0.0
+        self.recent = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += seconds
+            self.count += 1
+            self.min = min(self.min, seconds)
+            self.max = max(self.max, seconds)
+            self.recent.append(seconds)
+
+    def percentile(self, fraction):
+        with self.lock:
+            recent = sorted(self.recent)
+        return recent[min(len(recent) - 1, int(len(recent) * fraction))] if recent else 0.0
+
+class StageMetrics:
+    # One LatencyHistogram per request stage ('decode', 'inference', ..., 'total')
+    def __init__(self, buckets, window):
+        self.buckets = buckets
+        self.window = window
+        self.histograms = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, stage):
+        return self.histograms.get(stage)
+
+    def observe(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(stage, LatencyHistogram(self.buckets, self.window))
+        histogram.observe(seconds)
+
+    def observe_timings(self, timings):
+        for stage, elapsed_ns in timings.items():
+            self.observe(stage, elapsed_ns / 1e9)
+
+def lap(timings, stage, since):
+    # Adds the time since `since` (perf_counter_ns) to a stage and returns now, so
+    # consecutive stages can be chained without reading the clock twice
+    now = time.perf_counter_ns()
+    timings[stage] = timings.get(stage, 0) + now - since
+    return now
+
 # Add global variables for tracking
-processing_times = []
+stage_metrics = StageMetrics(LATENCY_BUCKETS, LATENCY_WINDOW)
 total_images_processed = 0
 category_stats = defaultdict(int)
 model = None # Placeholder for the loaded YOLO model
+inference_backend = None # Placeholder for the ONNX Runtime / OpenVINO backend, if selected
+worker_pool = None # Placeholder for the multi-process inference pool
+batcher = None # Placeholder for the micro-batching scheduler
+verdict_cache = None # Placeholder for the image-hash verdict cache
+verdict_store = None # Placeholder for the on-disk verdict store
+archiver = None # Placeholder for the background image archiver
+asgi_bridge = None # Placeholder for the ASGI front end (--asgi)
 
 # Configuration for EraX Model
 ERAX_MODEL_REPO_ID = "erax-ai/EraX-NSFW-V1.0"
 ERAX_MODEL_FILENAME = "erax_nsfw_yolo11n.pt"  # Nano version selected
 ERAX_MODEL_LOCAL_DIR = "./erax_model_cache"
+DEFAULT_MODEL_INPUT_SIZE = 640  # Used when the checkpoint does not record its imgsz
 
 # Define NSFW classes and threshold
 NSFW_CLASSES = ['PENIS', 'VAGINA', 'NIPPLE', 'ANUS', 'MAKE_LOVE']
@@ -57,34 +204,82 @@ UNSAFE_CONTEXT_PATTERNS = [
     r'\b(rape|snuff|gore|bestiality|child abuse)\b'
 ]
 UNSAFE_WORD_THRESHOLD = 0.005
+CONTEXT_CACHE_SIZE = 4096  # Memoized URL/title and alt-text classifications
+
+# All keyword lists as one case-insensitive regex, scanned once per text; the named
+# group that matched tells which UNSAFE_CONTEXT_PATTERNS entry fired
+UNSAFE_CONTEXT_REGEX = re.compile(
+    '|'.join(f'(?P<group{index}>{pattern})' for index, pattern in enumerate(UNSAFE_CONTEXT_PATTERNS)),
+    re.IGNORECASE)
 
 # Create a directory structure for saving images
 BASE_DIR = r"C:\Users\alexc\Desktop\vsfiles\for_live_browsing\adblock_nsfw_test\some_tests_ext_thr\yolov11"
 THRESHOLD_DIR = f"test_threshold_{DEFAULT_NSFW_THRESHOLD}"
 FULL_DIR = os.path.join(BASE_DIR, THRESHOLD_DIR)
+VERDICT_STORE_PATH = os.path.join(BASE_DIR, "verdict_store.sqlite3")
 
 for category in ['images', 'thumbnails']:
     for subcategory in ['original', 'sfw', 'nsfw']:
         os.makedirs(os.path.join(FULL_DIR, category, subcategory), exist_ok=True)
 
 def print_statistics():
-    if processing_times:
-        avg_time = mean(processing_times)
+    total = stage_metrics.get('total')
+    if total is not None and total.count:
         print("\n=== Processing Statistics ===")
         print(f"Total images processed: {total_images_processed}")
-        print(f"Average processing time: {avg_time:.2f} seconds")
-        print(f"Fastest processing time: {min(processing_times):.2f} seconds")
-        print(f"Slowest processing time: {max(processing_times):.2f} seconds")
+        print(f"Average processing time: {total.sum / total.count:.2f} seconds")
+        print(f"Fastest processing time: {total.min:.2f} seconds")
+        print(f"Slowest processing time: {total.max:.2f} seconds")
+        print("\n=== Stage Latency (recent p50 / p95, ms) ===")
+        for stage, histogram in list(stage_metrics.histograms.items()):
+            print(f"{stage}: {1000 * histogram.percentile(0.5):.1f} / {1000 * histogram.percentile(0.95):.1f} ({histogram.count} samples)")
         print("\n=== Category-wise Statistics ===")
         for category, count in category_stats.items():
             if count > 0:
                 print(f"{category}: {count} images")
+        if batcher is not None and batcher.batch_size_counts:
+            sizes = batcher.batch_size_counts
+            total_batches = sum(sizes.values())
+            avg_batch = sum(size * count for size, count in sizes.items()) / total_batches
+            print("\n=== Batching Statistics ===")
+            print(f"Forward passes: {total_batches} (average batch size {avg_batch:.2f})")
+            for size in sorted(sizes):
+                print(f"batch of {size}: {sizes[size]} passes")
+        if worker_pool is not None:
+            print("\n=== Worker Statistics ===")
+            for worker_index in sorted(worker_pool.tasks_per_worker):
+                print(f"worker {worker_index}: {worker_pool.tasks_per_worker[worker_index]} forward passes")
+            print(f"Worker restarts: {worker_pool.restarts}")
+        if verdict_cache is not None:
+            hits = verdict_cache.raw_hits + verdict_cache.pixel_hits + verdict_cache.near_hits
+            lookups = hits + verdict_cache.misses
+            hit_rate = 100.0 * hits / lookups if lookups else 0.0
+            print("\n=== Verdict Cache Statistics ===")
+            print(f"Entries: {len(verdict_cache.entries)} / {verdict_cache.max_entries}")
+            print(f"Hits: {hits} ({verdict_cache.raw_hits} raw, {verdict_cache.pixel_hits} pixel, {verdict_cache.near_hits} near-duplicate) - Misses: {verdict_cache.misses} - Hit rate: {hit_rate:.1f}%")
+            print(f"Evictions: {verdict_cache.evictions}")
+            if verdict_cache.store is not None:
+                print(f"Verdict store: {verdict_cache.store.hits} read-through hits, {verdict_cache.store.writes} verdicts written")
+            if verdict_cache.near_duplicates:
+                if verdict_cache.near_verified:
+                    differed_rate = 100.0 * verdict_cache.near_differed / verdict_cache.near_verified
+                    print(f"Near-duplicate verdicts re-checked: {verdict_cache.near_verified} - differed: {verdict_cache.near_differed} ({differed_rate:.1f}%)")
+        site_cache = match_site_rule.cache_info()
+        keyword_cache = find_unsafe_keyword.cache_info()
+        print(f"\nContext memo: site rules {site_cache.hits} hits / {site_cache.misses} misses, "
+              f"keywords {keyword_cache.hits} hits / {keyword_cache.misses} misses")
+        if in_flight_detections.coalesced:
+            print(f"\nCoalesced with an identical in-flight image: {in_flight_detections.coalesced}")
+        if video_streams.streams:
+            print(f"\nVideo streams: {len(video_streams.streams)} live")
+        if archiver is not None:
+            print(f"\nArchive: {archiver.written} images written, {archiver.dropped} dropped, {archiver.queue.qsize()} queued")
         print("==========================\n")
 
 atexit.register(print_statistics)
 
 def load_erax_nsfw_model():
-    global model
+    global model, inference_backend
     model_path = os.path.join(ERAX_MODEL_LOCAL_DIR, ERAX_MODEL_FILENAME)
     if not os.path.exists(model_path):
         print(f"Downloading EraX NSFW model: {ERAX_MODEL_FILENAME} from {ERAX_MODEL_REPO_ID}...")
@@ -112,6 +307,983 @@ def load_erax_nsfw_model():
         print(f"Error loading EraX YOLO model: {e}")
         sys.exit(1)
 
+    if INFERENCE_BACKEND != 'ultralytics':
+        inference_backend = load_onnx_backend(model_path, INFERENCE_BACKEND, ONNX_QUANTIZE_INT8)
+
+def load_onnx_backend(model_path, engine, quantize_int8):
+    try:
+        imgsz = get_model_input_size()
+        onnx_path = export_onnx_model(model_path, imgsz, quantize_int8)
+        backend = OnnxYoloBackend(onnx_path, model.names, imgsz, engine,
+                                  INFERENCE_INTRA_OP_THREADS, INFERENCE_INTER_OP_THREADS)
+        print(f"Serving {os.path.basename(onnx_path)} through {engine}")
+        return backend
+    except Exception as e:
+        print(f"Error loading {engine} backend: {e}")
+        sys.exit(1)
+
+def get_model_input_size():
+    # Square side the model letterboxes to, as recorded in the loaded checkpoint
+    imgsz = None
+    if model is not None:
+        imgsz = model.overrides.get('imgsz')
+        if imgsz is None:
+            train_args = getattr(model.model, 'args', None)
+            imgsz = train_args.get('imgsz') if isinstance(train_args, dict) else getattr(train_args, 'imgsz', None)
+    if isinstance(imgsz, (list, tuple)):
+        imgsz = max(imgsz)
+    return int(imgsz or DEFAULT_MODEL_INPUT_SIZE)
+
+def non_max_suppression(boxes, scores, iou_threshold):
+    # Indices of the boxes kept by greedy NMS, highest score first (boxes are xyxy)
+    order = scores.argsort()[::-1]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = []
+    while order.size > 0:
+        best = order[0]
+        keep.append(best)
+        rest = order[1:]
+        x1 = np.maximum(boxes[best, 0], boxes[rest, 0])
+        y1 = np.maximum(boxes[best, 1], boxes[rest, 1])
+        x2 = np.minimum(boxes[best, 2], boxes[rest, 2])
+        y2 = np.minimum(boxes[best, 3], boxes[rest, 3])
+        intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+        iou = intersection / (areas[best] + areas[rest] - intersection + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+def export_onnx_model(model_path, imgsz, quantize_int8=False):
+    # Exports the checkpoint to ONNX next to it (once) and optionally writes an INT8 copy
+    onnx_path = os.path.splitext(model_path)[0] + ".onnx"
+    if not os.path.exists(onnx_path):
+        print(f"Exporting {model_path} to ONNX (imgsz {imgsz}, dynamic batch)...")
+        onnx_path = YOLO(model_path).export(format='onnx', imgsz=imgsz, dynamic=True, simplify=True)
+    if not quantize_int8:
+        return onnx_path
+    int8_path = os.path.splitext(onnx_path)[0] + "_int8.onnx"
+    if not os.path.exists(int8_path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        print(f"Quantizing {onnx_path} to INT8...")
+        quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QUInt8)
+    return int8_path
+
+class OnnxYoloBackend:
+    # Serves the exported YOLO graph through ONNX Runtime or OpenVINO on CPU, with our own
+    # letterbox, batching and NMS in place of Ultralytics' per-call predictor overhead.
+    def __init__(self, onnx_path, class_names, imgsz, engine='onnxruntime',
+                 intra_op_threads=0, inter_op_threads=0, iou_threshold=0.7, max_detections=300):
+        self.onnx_path = onnx_path
+        self.class_names = [class_names[i].upper() for i in sorted(class_names)]
+        self.imgsz = imgsz
+        self.engine = engine
+        self.iou_threshold = iou_threshold
+        self.max_detections = max_detections
+        if engine == 'onnxruntime':
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if intra_op_threads:
+                options.intra_op_num_threads = intra_op_threads
+            if inter_op_threads:
+                options.inter_op_num_threads = inter_op_threads
+                options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+            self.session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+            self.input_name = self.session.get_inputs()[0].name
+        elif engine == 'openvino':
+            import openvino as ov
+            core = ov.Core()
+            properties = {}
+            if intra_op_threads:
+                properties['INFERENCE_NUM_THREADS'] = intra_op_threads
+            if inter_op_threads:
+                properties['NUM_STREAMS'] = inter_op_threads
+            self.compiled = core.compile_model(onnx_path, 'CPU', properties)
+            self.output = self.compiled.output(0)
+        else:
+            raise ValueError(f"Unknown inference engine: {engine}")
+
+    def _letterbox(self, img_np):
+        # Same resize-and-pad as Ultralytics' LetterBox (pad value 114, centred)
+        height, width = img_np.shape[:2]
+        gain = min(self.imgsz / height, self.imgsz / width)
+        new_width, new_height = int(round(width * gain)), int(round(height * gain))
+        pad_x, pad_y = (self.imgsz - new_width) / 2, (self.imgsz - new_height) / 2
+        canvas = np.full((self.imgsz, self.imgsz, 3), 114, dtype=np.uint8)
+        left, top = int(round(pad_x - 0.1)), int(round(pad_y - 0.1))
+        if (new_width, new_height) != (width, height):
+            img_np = cv2.resize(img_np, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+        canvas[top:top + new_height, left:left + new_width] = img_np
+        return canvas, gain, (left, top)
+
+    def _forward(self, batch):
+        if self.engine == 'onnxruntime':
+            return self.session.run(None, {self.input_name: batch})[0]
+        return self.compiled(batch)[self.output]
+
+    def predict(self, images, conf):
+        # Ultralytics treats numpy input as BGR and flips it, so flip the same way here
+        # to feed the network exactly what the PyTorch path does
+        letterboxed = [self._letterbox(img_np) for img_np in images]
+        batch = np.stack([canvas[..., ::-1] for canvas, _, _ in letterboxed])
+        batch = np.ascontiguousarray(batch.transpose(0, 3, 1, 2), dtype=np.float32) / 255.0
+        outputs = self._forward(batch)  # (N, 4 + classes, anchors)
+
+        all_detections = []
+        for output, img_np, (_, gain, (left, top)) in zip(outputs, images, letterboxed):
+            predictions = output.T
+            scores = predictions[:, 4:]
+            class_ids = scores.argmax(axis=1)
+            confidences = scores[np.arange(len(scores)), class_ids]
+            mask = confidences >= conf
+            detections = []
+            if mask.any():
+                xywh, class_ids, confidences = predictions[mask, :4], class_ids[mask], confidences[mask]
+                boxes = np.empty_like(xywh)
+                boxes[:, :2] = xywh[:, :2] - xywh[:, 2:] / 2
+                boxes[:, 2:] = xywh[:, :2] + xywh[:, 2:] / 2
+                # Offset boxes per class so one NMS call never suppresses across classes
+                offset_boxes = boxes + class_ids[:, None] * float(self.imgsz * 2)
+                keep = non_max_suppression(offset_boxes, confidences, self.iou_threshold)[:self.max_detections]
+                # Undo the letterbox and normalize boxes to the original image
+                height, width = img_np.shape[:2]
+                boxes = (boxes - [left, top, left, top]) / gain / [width, height, width, height]
+                boxes = np.clip(boxes, 0.0, 1.0)
+                for i in keep:
+                    detections.append({'class': self.class_names[class_ids[i]], 'confidence': float(confidences[i]),
+                                       'box': [round(float(v), 4) for v in boxes[i]]})
+            all_detections.append(detections)
+        return all_detections
+
+def submit_model(images, conf):
+    # Future for one forward pass: handed to a worker process when the pool is running,
+    # otherwise run right here
+    if worker_pool is not None:
+        return worker_pool.submit(images, conf)
+    future = Future()
+    try:
+        future.set_result(run_model(images, conf))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def wait_for_detections(future):
+    # A forward pass that never finishes (e.g. its worker hung) fails the request instead of blocking it
+    try:
+        return future.result(timeout=INFERENCE_TIMEOUT_SECONDS)
+    except FutureTimeoutError:
+        raise RuntimeError(f"Inference did not finish within {INFERENCE_TIMEOUT_SECONDS}s") from None
+
+def run_model(images, conf):
+    # One forward pass over a list of RGB images, one detection list per image
+    if inference_backend is not None:
+        return inference_backend.predict(images, conf)
+    return run_ultralytics_model(images, conf)
+
+def run_ultralytics_model(images, conf):
+    try:
+        with torch.no_grad():
+            results = model(images, conf=conf, verbose=False)
+    except RuntimeError as e:
+        if "Cannot set version_counter for inference tensor" in str(e):
+            print("Handling inference tensor error - trying with CPU copy")
+            results = model([img.copy() for img in images], conf=conf, verbose=False)
+        else:
+            raise
+
+    all_detections = []
+    for result in results:
+        boxes = result.boxes
+        detections = []
+        for i in range(len(boxes)):
+            cls_id = int(boxes.cls[i].item())
+            conf_value = boxes.conf[i].item()
+            cls_name = result.names[cls_id].upper()
+            box = [round(v, 4) for v in boxes.xyxyn[i].tolist()]  # x1, y1, x2, y2 as fractions of the image
+            detections.append({'class': cls_name, 'confidence': conf_value, 'box': box})
+        all_detections.append(detections)
+    return all_detections
+
+def inference_worker_main(worker_index, task_queue, result_conn, slot_names, threads, cpu_ids):
+    # Entry point of one inference worker process: its own model instance and thread
+    # budget, reading images straight out of the shared-memory slots named in each task
+    global INFERENCE_INTRA_OP_THREADS
+    if cpu_ids and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpu_ids)
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(1)
+    INFERENCE_INTRA_OP_THREADS = threads
+    load_erax_nsfw_model()
+    slots = [shared_memory.SharedMemory(name=name) for name in slot_names]
+    print(f"Inference worker {worker_index} ready ({threads} threads)")
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        task_id, items, conf = task
+        images = [np.ndarray(shape, dtype=np.uint8, buffer=slots[slot].buf) for slot, shape in items]
+        try:
+            result = (task_id, worker_index, run_model(images, conf), None)
+        except Exception as e:
+            result = (task_id, worker_index, None, str(e))
+        result_conn.send(result)
+        del images
+    for slot in slots:
+        slot.close()
+
+class InferenceWorkerPool:
+    # N inference processes, each with its own task queue and result pipe, so every task
+    # has a known owner and a worker dying mid-write cannot jam the others' results.
+    # Pixels travel through a fixed set of shared-memory slots; only (slot, shape) tuples
+    # and detections are pickled. A worker that dies fails the tasks it owned, returns
+    # their slots and is started again.
+    def __init__(self, num_workers, threads_per_worker, num_slots, slot_bytes):
+        self.context = multiprocessing.get_context('spawn')
+        self.threads_per_worker = threads_per_worker
+        self.slot_bytes = slot_bytes
+        self.slots = [shared_memory.SharedMemory(create=True, size=slot_bytes) for _ in range(num_slots)]
+        self.free_slots = queue.Queue()
+        self.acquire_lock = threading.Lock()
+        for index in range(num_slots):
+            self.free_slots.put(index)
+        self.pending = {}  # task_id -> (future, slot indices, worker index, submitted at)
+        self.pending_lock = threading.Lock()
+        self.next_task_id = 0
+        self.tasks_per_worker = defaultdict(int)
+        self.restarts = 0
+        self.closing = False
+        self.workers = [None] * num_workers
+        self.task_queues = [None] * num_workers
+        self.result_readers = [None] * num_workers
+        for worker_index in range(num_workers):
+            self._start_worker(worker_index)
+        self.collector = threading.Thread(target=self._collect, name="worker-results", daemon=True)
+        self.collector.start()
+
+    def _start_worker(self, worker_index):
+        # Fresh channels each time, so nothing meant for a dead worker is picked up twice
+        cpu_count = os.cpu_count() or 1
+        first_cpu = (worker_index * self.threads_per_worker) % cpu_count
+        cpu_ids = {(first_cpu + offset) % cpu_count for offset in range(self.threads_per_worker)}
+        task_queue = self.context.Queue()
+        result_reader, result_writer = self.context.Pipe(duplex=False)
+        worker = self.context.Process(
+            target=inference_worker_main, name=f"inference-worker-{worker_index}", daemon=True,
+            args=(worker_index, task_queue, result_writer,
+                  [slot.name for slot in self.slots], self.threads_per_worker, cpu_ids))
+        worker.start()
+        result_writer.close()  # Only the worker writes, so its exit shows up as EOF here
+        self.task_queues[worker_index] = task_queue
+        self.result_readers[worker_index] = result_reader
+        self.workers[worker_index] = worker
+
+    def _to_slot(self, img_np, slot_index):
+        # Images larger than a slot are downscaled to fit; the model letterboxes them anyway
+        height, width = img_np.shape[:2]
+        max_pixels = self.slot_bytes // 3
+        if height * width > max_pixels:
+            scale = (max_pixels / (height * width)) ** 0.5
+            img_np = cv2.resize(img_np, (max(int(width * scale), 1), max(int(height * scale), 1)), interpolation=cv2.INTER_AREA)
+        view = np.ndarray(img_np.shape, dtype=np.uint8, buffer=self.slots[slot_index].buf)
+        view[...] = img_np
+        return slot_index, img_np.shape
+
+    def submit(self, images, conf):
+        # Blocks while every slot is in use, which caps how much work can pile up, for at
+        # most INFERENCE_TIMEOUT_SECONDS. Slots for one call are taken under a lock so two
+        # callers never each hold part of what they need and wait on each other.
+        if len(images) > len(self.slots):
+            raise ValueError(f"Cannot submit {len(images)} images to a pool with {len(self.slots)} slots")
+        items = []
+        with self.acquire_lock:
+            try:
+                for img_np in images:
+                    items.append(self._to_slot(img_np, self.free_slots.get(timeout=INFERENCE_TIMEOUT_SECONDS)))
+            except BaseException as e:
+                for slot_index, _ in items:
+                    self.free_slots.put(slot_index)
+                if isinstance(e, queue.Empty):
+                    raise RuntimeError(f"No free inference worker slot within {INFERENCE_TIMEOUT_SECONDS}s") from None
+                raise
+        future = Future()
+        with self.pending_lock:
+            task_id = self.next_task_id
+            self.next_task_id += 1
+            # The worker with the fewest tasks outstanding takes it
+            load = defaultdict(int)
+            for _, _, owner, _ in self.pending.values():
+                load[owner] += 1
+            worker_index = min(range(len(self.workers)), key=lambda index: load[index])
+            self.pending[task_id] = (future, [slot for slot, _ in items], worker_index, time.monotonic())
+            self.task_queues[worker_index].put((task_id, items, conf))
+        return future
+
+    def _collect(self):
+        # Wakes on any result or any worker exiting; results a worker sent before dying
+        # are handled before it is replaced
+        while not self.closing:
+            readers = list(self.result_readers)
+            try:
+                ready = multiprocessing.connection.wait(readers + [worker.sentinel for worker in self.workers], timeout=1.0)
+            except (OSError, ValueError):
+                continue  # A reader closed by close() or a replacement under our feet
+            for reader in readers:
+                if reader not in ready:
+                    continue
+                try:
+                    task_id, worker_index, detections, error = reader.recv()
+                except (EOFError, OSError):
+                    continue  # The worker exited; the liveness check below replaces it
+                self._settle(task_id, worker_index, detections, error)
+            # A worker stuck on a task long after its caller gave up is killed, which frees its slots
+            cutoff = time.monotonic() - 2 * INFERENCE_TIMEOUT_SECONDS
+            with self.pending_lock:
+                stuck = {owner for _, _, owner, submitted in self.pending.values() if submitted < cutoff}
+            for worker_index in stuck:
+                self.workers[worker_index].kill()
+            for worker_index, worker in enumerate(self.workers):
+                if not worker.is_alive() and not self.closing:
+                    self._replace_worker(worker_index)
+
+    def _settle(self, task_id, worker_index, detections, error):
+        with self.pending_lock:
+            entry = self.pending.pop(task_id, None)
+        if entry is None:
+            return  # Already failed when its worker was replaced
+        future, slot_indices, _, _ = entry
+        for slot_index in slot_indices:
+            self.free_slots.put(slot_index)
+        self.tasks_per_worker[worker_index] += 1
+        if error is not None:
+            future.set_exception(RuntimeError(f"Inference worker {worker_index}: {error}"))
+        else:
+            future.set_result(detections)
+
+    def _replace_worker(self, worker_index):
+        exitcode = self.workers[worker_index].exitcode
+        with self.pending_lock:
+            lost = [task_id for task_id, (_, _, owner, _) in self.pending.items() if owner == worker_index]
+            entries = [self.pending.pop(task_id) for task_id in lost]
+            self.result_readers[worker_index].close()
+            self._start_worker(worker_index)
+        self.restarts += 1
+        print(f"Inference worker {worker_index} exited (code {exitcode}); failed {len(entries)} tasks and restarted it")
+        for future, slot_indices, _, _ in entries:
+            for slot_index in slot_indices:
+                self.free_slots.put(slot_index)
+            future.set_exception(RuntimeError(f"Inference worker {worker_index} exited (code {exitcode})"))
+
+    def close(self):
+        self.closing = True
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+        for reader in self.result_readers:
+            reader.close()
+        for slot in self.slots:
+            slot.close()
+            slot.unlink()
+
+class MicroBatcher:
+    # Collects concurrent requests for up to max_batch_size images or max_wait_ms,
+    # runs them as one forward pass at the lowest threshold in the batch and hands
+    # each waiting request its own detections back through a Future.
+    def __init__(self, max_batch_size, max_wait_ms):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.batch_size_counts = defaultdict(int)
+        self.thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, img_np, threshold):
+        future = Future()
+        self.queue.put((img_np, threshold, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                # A failed hand-off fails this batch only; the thread must keep serving
+                print(f"Error running batch of {len(batch)} images: {e}")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _run_batch(self, batch):
+        # With a worker pool this returns as soon as the batch is handed off, so
+        # the next batch can be collected while workers run this one
+        images = [img_np for img_np, _, _ in batch]
+        conf = min(threshold for _, threshold, _ in batch)
+        self.batch_size_counts[len(batch)] += 1
+
+        def fan_out(model_future):
+            try:
+                all_detections = model_future.result()
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                return
+            for (_, _, future), detections in zip(batch, all_detections):
+                future.set_result(detections)
+
+        submit_model(images, conf).add_done_callback(fan_out)
+
+def dhash(img_np):
+    # 64-bit difference hash: survives resizing and recompression, unlike the pixel hash.
+    # Returns None for flat images, whose hashes collide with every other flat image.
+    gray = cv2.cvtColor(img_np, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    set_bits = int(bits.sum())
+    if set_bits < PHASH_MIN_DETAIL_BITS or set_bits > 64 - PHASH_MIN_DETAIL_BITS:
+        return None
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    # Metric tree over perceptual hashes for Hamming-radius queries.
+    # Nodes are [hash, value, {distance: child}]; removals are handled by the caller
+    # checking values for staleness and rebuilding the tree from time to time.
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, item_hash, value):
+        node = [item_hash, value, {}]
+        if self.root is None:
+            self.root = node
+            self.size += 1
+            return
+        current = self.root
+        while True:
+            distance = hamming_distance(item_hash, current[0])
+            if distance == 0:
+                current[1] = value
+                return
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                self.size += 1
+                return
+            current = child
+
+    def search(self, item_hash, max_distance):
+        # All (distance, value) pairs within max_distance, closest first
+        matches = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(item_hash, node[0])
+            if distance <= max_distance:
+                matches.append((distance, node[1]))
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+class VerdictStore:
+    # SQLite (WAL mode) copy of the verdict cache so detections survive restarts.
+    # Lookups use one read connection per thread; writes are queued and committed
+    # in batches by a single writer thread, so predict() never waits on the disk.
+    # The writer also prunes expired rows every VERDICT_STORE_PRUNE_INTERVAL_SECONDS.
+    def __init__(self, path, model_name):
+        self.path = path
+        self.model_name = model_name
+        self.local = threading.local()
+        self.pending = queue.Queue()
+        self.hits = 0
+        self.writes = 0
+        connection = sqlite3.connect(path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""CREATE TABLE IF NOT EXISTS verdicts (
+            pixel_key TEXT PRIMARY KEY, model TEXT NOT NULL, detections TEXT NOT NULL,
+            shape TEXT NOT NULL, phash TEXT, updated REAL NOT NULL)""")
+        connection.execute("CREATE INDEX IF NOT EXISTS verdicts_updated ON verdicts (updated)")
+        connection.execute("CREATE TABLE IF NOT EXISTS raw_keys (raw_key TEXT PRIMARY KEY, pixel_key TEXT NOT NULL)")
+        self.pruned = self._prune(connection)
+        connection.close()
+        self.writer = threading.Thread(target=self._write_loop, name="verdict-store-writer", daemon=True)
+        self.writer.start()
+
+    @staticmethod
+    def _prune(connection):
+        # Deletes verdicts older than VERDICT_STORE_MAX_AGE_SECONDS and every raw-key alias
+        # left pointing at a verdict that is gone; returns how many verdicts went
+        deleted = connection.execute("DELETE FROM verdicts WHERE updated < ?",
+                                     (time.time() - VERDICT_STORE_MAX_AGE_SECONDS,)).rowcount
+        connection.execute("DELETE FROM raw_keys WHERE NOT EXISTS "
+                           "(SELECT 1 FROM verdicts WHERE verdicts.pixel_key = raw_keys.pixel_key)")
+        connection.commit()
+        return deleted
+
+    def _reader(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            connection.execute("PRAGMA query_only=1")
+            self.local.connection = connection
+        return connection
+
+    @staticmethod
+    def _decode_row(row):
+        pixel_key, detections, shape, phash = row
+        return pixel_key, json.loads(detections), tuple(json.loads(shape)), int(phash, 16) if phash else None
+
+    def load(self, pixel_key=None, raw_key=None):
+        # (pixel_key, detections, shape, phash) for a stored image, or None
+        if pixel_key is None:
+            row = self._reader().execute("SELECT pixel_key FROM raw_keys WHERE raw_key = ?", (raw_key,)).fetchone()
+            if row is None:
+                return None
+            pixel_key = row[0]
+        row = self._reader().execute(
+            "SELECT pixel_key, detections, shape, phash FROM verdicts WHERE pixel_key = ? AND model = ?",
+            (pixel_key, self.model_name)).fetchone()
+        if row is None:
+            return None
+        self.hits += 1
+        return self._decode_row(row)
+
+    def recent(self, limit):
+        # Newest stored verdicts first, read lazily so warming never holds more than the cache does
+        cursor = self._reader().execute(
+            "SELECT pixel_key, detections, shape, phash FROM verdicts WHERE model = ? ORDER BY updated DESC LIMIT ?",
+            (self.model_name, limit))
+        for row in cursor:
+            yield self._decode_row(row)
+
+    def save(self, pixel_key, raw_key, detections, shape, phash):
+        self.pending.put((pixel_key, raw_key, json.dumps(detections), json.dumps(list(shape)),
+                          format(phash, '016x') if phash is not None else None, time.time()))
+
+    def _write_loop(self):
+        connection = sqlite3.connect(self.path)
+        next_prune = time.monotonic() + VERDICT_STORE_PRUNE_INTERVAL_SECONDS
+        while True:
+            if time.monotonic() >= next_prune:
+                try:
+                    self.pruned += self._prune(connection)
+                except sqlite3.Error as e:
+                    print(f"Error pruning verdict store: {e}")
+                next_prune = time.monotonic() + VERDICT_STORE_PRUNE_INTERVAL_SECONDS
+            try:
+                rows = [self.pending.get(timeout=max(0.0, next_prune - time.monotonic()))]
+            except queue.Empty:
+                continue
+            while len(rows) < 256:
+                try:
+                    rows.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in rows
+            rows = [row for row in rows if row is not None]
+            try:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO verdicts (pixel_key, model, detections, shape, phash, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(row[0], self.model_name, row[2], row[3], row[4], row[5]) for row in rows])
+                connection.executemany(
+                    "INSERT OR REPLACE INTO raw_keys (raw_key, pixel_key) VALUES (?, ?)",
+                    [(row[1], row[0]) for row in rows if row[1] is not None])
+                connection.commit()
+                self.writes += len(rows)
+            except sqlite3.Error as e:
+                print(f"Error writing verdict store: {e}")
+            if stop:
+                connection.close()
+                return
+
+    def close(self):
+        # Flushes queued writes; registered with atexit
+        self.pending.put(None)
+        self.writer.join(timeout=10)
+
+class VerdictCache:
+    # LRU of raw detections keyed by a hash of the decoded pixels, with a second
+    # map from a hash of the request's base64 string so repeats can skip decoding.
+    # Detections are stored at RAW_DETECTION_CONF so any threshold can be applied later.
+    # With near_duplicates enabled, a BK-tree over dHashes finds resized/recompressed copies.
+    # An optional VerdictStore is written through on put() and read through on misses.
+    def __init__(self, max_entries, ttl_seconds, near_duplicates=False, max_distance=PHASH_MAX_DISTANCE, store=None):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.entries = OrderedDict()   # pixel_key -> (detections, shape, created, phash)
+        self.raw_keys = OrderedDict()  # raw_key -> pixel_key
+        self.lock = threading.Lock()
+        self.raw_hits = 0
+        self.pixel_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.near_duplicates = near_duplicates
+        self.max_distance = max_distance
+        self.phash_tree = BKTree()
+        self.near_hits = 0
+        self.near_verified = 0
+        self.near_differed = 0
+        self.store = store
+
+    @staticmethod
+    def raw_key(encoded_image):
+        # Hash of the image as sent: a base64 string or the raw bytes of a binary upload
+        if isinstance(encoded_image, str):
+            encoded_image = encoded_image.encode('ascii', 'ignore')
+        return hashlib.blake2b(encoded_image, digest_size=16).hexdigest()
+
+    @staticmethod
+    def pixel_key(img_np):
+        digest = hashlib.blake2b(np.ascontiguousarray(img_np), digest_size=16)
+        digest.update(str(img_np.shape).encode())
+        return digest.hexdigest()
+
+    def _lookup(self, pixel_key):
+        entry = self.entries.get(pixel_key)
+        if entry is None:
+            return None
+        if time.time() - entry[2] > self.ttl:
+            del self.entries[pixel_key]
+            self.evictions += 1
+            return None
+        self.entries.move_to_end(pixel_key)
+        return entry
+
+    def get_by_raw(self, raw_key):
+        # Fast pre-check before decoding; a miss here is not counted as a cache miss
+        with self.lock:
+            pixel_key = self.raw_keys.get(raw_key)
+            entry = self._lookup(pixel_key) if pixel_key is not None else None
+            if entry is not None:
+                self.raw_keys.move_to_end(raw_key)
+                self.raw_hits += 1
+                return entry
+            if pixel_key is not None:
+                del self.raw_keys[raw_key]
+        stored = self.store.load(raw_key=raw_key) if self.store is not None else None
+        if stored is None:
+            return None
+        with self.lock:
+            self.raw_hits += 1
+            return self._insert(*stored, raw_key=raw_key)
+
+    def get_by_pixels(self, pixel_key, raw_key=None):
+        with self.lock:
+            entry = self._lookup(pixel_key)
+            if entry is not None:
+                if raw_key is not None:
+                    self._remember_raw(raw_key, pixel_key)
+                self.pixel_hits += 1
+                return entry
+        stored = self.store.load(pixel_key=pixel_key) if self.store is not None else None
+        with self.lock:
+            if stored is not None:
+                self.pixel_hits += 1
+                return self._insert(*stored, raw_key=raw_key)
+            # With near-duplicate matching the miss is only final once get_near fails too
+            if not self.near_duplicates:
+                self.misses += 1
+            return None
+
+    def get_near(self, phash):
+        # Closest live entry within max_distance of phash; only called after an exact miss
+        with self.lock:
+            if phash is None:
+                self.misses += 1
+                return None
+            for distance, pixel_key in self.phash_tree.search(phash, self.max_distance):
+                entry = self._lookup(pixel_key)
+                if entry is not None:
+                    self.near_hits += 1
+                    return entry
+            self.misses += 1
+            return None
+
+    def record_near_check(self, differed):
+        with self.lock:
+            self.near_verified += 1
+            if differed:
+                self.near_differed += 1
+
+    def put(self, pixel_key, raw_key, detections, shape, phash=None):
+        with self.lock:
+            self._insert(pixel_key, detections, shape, phash, raw_key=raw_key)
+        if self.store is not None:
+            self.store.save(pixel_key, raw_key, detections, shape, phash)
+
+    def warm(self, limit):
+        # Loads the newest stored verdicts, oldest of them first so LRU order matches the store
+        if self.store is None:
+            return 0
+        stored = list(self.store.recent(min(limit, self.max_entries)))
+        with self.lock:
+            for row in reversed(stored):
+                self._insert(*row)
+        return len(stored)
+
+    def _insert(self, pixel_key, detections, shape, phash, raw_key=None):
+        entry = (detections, shape, time.time(), phash)
+        self.entries[pixel_key] = entry
+        self.entries.move_to_end(pixel_key)
+        if raw_key is not None:
+            self._remember_raw(raw_key, pixel_key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        if phash is not None and self.near_duplicates:
+            self.phash_tree.add(phash, pixel_key)
+            # Evicted keys stay in the tree until it grows well past the live entries
+            if self.phash_tree.size > 2 * max(len(self.entries), 1024):
+                self._rebuild_phash_tree()
+        return entry
+
+    def _rebuild_phash_tree(self):
+        self.phash_tree = BKTree()
+        for pixel_key, entry in self.entries.items():
+            if entry[3] is not None:
+                self.phash_tree.add(entry[3], pixel_key)
+
+    def _remember_raw(self, raw_key, pixel_key):
+        self.raw_keys[raw_key] = pixel_key
+        self.raw_keys.move_to_end(raw_key)
+        # Several encodings may alias one image, so allow twice as many aliases as entries
+        while len(self.raw_keys) > 2 * self.max_entries:
+            self.raw_keys.popitem(last=False)
+
+def skin_tone_ratio(img_np):
+    # Share of a small thumbnail's pixels inside the classic YCrCb skin-tone box, or None
+    # when the image has too little colour for skin tone to mean anything
+    small = cv2.resize(img_np, (PREFILTER_SIDE, PREFILTER_SIDE), interpolation=cv2.INTER_AREA)
+    ycrcb = cv2.cvtColor(small, cv2.COLOR_RGB2YCrCb).reshape(-1, 3).astype(np.int16)
+    y, cr, cb = ycrcb[:, 0], ycrcb[:, 1], ycrcb[:, 2]
+    if np.abs(cr - 128).mean() + np.abs(cb - 128).mean() < PREFILTER_MIN_CHROMA:
+        return None
+    skin = (y > 40) & (cr >= 133) & (cr <= 173) & (cb >= 77) & (cb <= 127)
+    return float(skin.mean())
+
+def prefilter_cutoff(threshold):
+    # The skin-tone cut-off shrinks with the detection threshold, so an escalated
+    # domain (UNSAFE_WORD_THRESHOLD) only skips images with next to no skin at all
+    return PREFILTER_SKIN_RATIO * threshold / DEFAULT_NSFW_THRESHOLD
+
+def is_confidently_safe(img_np, threshold):
+    # Images the tiled pass will look at are never skipped: one small region in a long
+    # screenshot or comic strip barely moves the whole-image skin ratio
+    height, width = img_np.shape[:2]
+    if tile_windows(height, width, get_model_input_size()) is not None:
+        return False
+    ratio = skin_tone_ratio(img_np)
+    return ratio is not None and ratio < prefilter_cutoff(threshold)
+
+def detect_many(images, thresholds):
+    # One detection list per image, or the exception its forward pass raised
+    if not images:
+        return []
+    if batcher is not None:
+        futures = [batcher.submit(img_np, threshold) for img_np, threshold in zip(images, thresholds)]
+        outcomes = []
+        for future in futures:
+            try:
+                outcomes.append(wait_for_detections(future))
+            except Exception as e:
+                outcomes.append(e)
+    else:
+        outcomes = wait_for_detections(submit_model(images, min(thresholds)))
+    # The pass ran at the lowest threshold involved, so apply each image's own threshold here
+    return [
+        outcome if isinstance(outcome, Exception)
+        else [d for d in outcome if d['confidence'] >= threshold]
+        for outcome, threshold in zip(outcomes, thresholds)
+    ]
+
+def tile_windows(height, width, imgsz):
+    # Overlapping (top, left, tile_height, tile_width) windows covering an image that the
+    # letterbox would shrink more than TILE_MAX_DOWNSCALE, or None when it would not
+    if not ENABLE_TILED_INFERENCE or max(height, width) <= imgsz * TILE_MAX_DOWNSCALE:
+        return None
+    side = int(imgsz * TILE_MAX_DOWNSCALE)
+    while True:
+        tile_height, tile_width = min(side, height), min(side, width)
+        stride_y = max(1, int(tile_height * (1 - TILE_OVERLAP)))
+        stride_x = max(1, int(tile_width * (1 - TILE_OVERLAP)))
+        rows = 1 + math.ceil((height - tile_height) / stride_y)
+        cols = 1 + math.ceil((width - tile_width) / stride_x)
+        if rows * cols <= TILE_MAX_COUNT:
+            break
+        side = int(side * 1.25)
+    return [(min(row * stride_y, height - tile_height), min(col * stride_x, width - tile_width), tile_height, tile_width)
+            for row in range(rows) for col in range(cols)]
+
+def merge_tile_detections(global_detections, tile_outcomes, windows, height, width):
+    # Maps tile boxes back onto the whole image and runs per-class NMS over them and the
+    # global pass, so an object seen by several overlapping tiles is reported once
+    merged = list(global_detections)
+    for detections, (top, left, tile_height, tile_width) in zip(tile_outcomes, windows):
+        for d in detections:
+            x1, y1, x2, y2 = d['box']
+            box = [(left + x1 * tile_width) / width, (top + y1 * tile_height) / height,
+                   (left + x2 * tile_width) / width, (top + y2 * tile_height) / height]
+            merged.append({'class': d['class'], 'confidence': d['confidence'], 'box': [round(v, 4) for v in box]})
+    if not merged:
+        return merged
+    class_names = sorted({d['class'] for d in merged})
+    boxes = np.array([d['box'] for d in merged], dtype=np.float64)
+    # Normalized boxes are at most 1 wide, so an offset of 2 per class keeps classes apart
+    offsets = np.array([class_names.index(d['class']) * 2.0 for d in merged])
+    keep = non_max_suppression(boxes + offsets[:, None], np.array([d['confidence'] for d in merged]), TILE_NMS_IOU)
+    return [merged[i] for i in keep]
+
+def refine_with_tiles(jobs, outcomes, inference_thresholds, chunk_size=None):
+    # Second pass for large images the global pass did not already flag: their tiles go
+    # through the model chunk_size (default BATCH_MAX_SIZE) at a time, and the merged
+    # detections replace the global ones. Tiles are cut per chunk, so only one chunk's
+    # crops exist at once.
+    imgsz = get_model_input_size()
+    chunk_size = chunk_size or BATCH_MAX_SIZE
+    tiled = []
+    for index, (job, outcome) in enumerate(zip(jobs, outcomes)):
+        if isinstance(outcome, Exception) or check_nsfw(outcome, job['threshold'])[0]:
+            continue
+        height, width = job['img_np'].shape[:2]
+        windows = tile_windows(height, width, imgsz)
+        if windows:
+            tiled.append((index, windows))
+    if not tiled:
+        return outcomes
+
+    tiles = [(index, window) for index, windows in tiled for window in windows]
+    tile_outcomes = []
+    for start in range(0, len(tiles), chunk_size):
+        chunk = tiles[start:start + chunk_size]
+        tile_images = [np.ascontiguousarray(jobs[index]['img_np'][top:top + tile_height, left:left + tile_width])
+                       for index, (top, left, tile_height, tile_width) in chunk]
+        try:
+            tile_outcomes += detect_many(tile_images, [inference_thresholds[index] for index, _ in chunk])
+        except Exception as e:
+            # Only the images with a tile in this chunk fail
+            tile_outcomes += [e] * len(chunk)
+
+    outcomes = list(outcomes)
+    start = 0
+    for index, windows in tiled:
+        chunk = tile_outcomes[start:start + len(windows)]
+        start += len(windows)
+        failure = next((o for o in chunk if isinstance(o, Exception)), None)
+        if failure is not None:
+            outcomes[index] = failure
+            continue
+        height, width = jobs[index]['img_np'].shape[:2]
+        outcomes[index] = merge_tile_detections(outcomes[index], chunk, windows, height, width)
+        category_stats['Tiled Images'] += 1
+    return outcomes
+
+class InFlightDetections:
+    # Single-flight table keyed by (pixel hash, inference threshold): the first request
+    # for some pixels runs the model and identical requests arriving meanwhile, from any
+    # thread or the same batch, wait on its Future instead of running their own pass
+    def __init__(self):
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.coalesced = 0
+
+    def claim(self, key):
+        # Returns (future, True) for the request that has to run the model, or the
+        # leader's future and False for everyone else
+        with self.lock:
+            future = self.futures.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = Future()
+            self.futures[key] = future
+            return future, True
+
+    def settle(self, key, outcome):
+        with self.lock:
+            future = self.futures.pop(key)
+        if isinstance(outcome, Exception):
+            future.set_exception(outcome)
+        else:
+            future.set_result(outcome)
+
+in_flight_detections = InFlightDetections()
+
+def resolve_detections(jobs):
+    # Detections for each prepared request: cached ones are re-thresholded, the rest
+    # go through one forward pass (plus a tiled pass for large images) and are stored
+    # raw so later hits can use any threshold. Images already being run for another
+    # request share that request's result.
+    clock = time.perf_counter_ns()
+    pending = [job for job in jobs if job['raw_detections'] is None]
+    if verdict_cache is not None:
+        inference_thresholds = [RAW_DETECTION_CONF] * len(pending)
+    else:
+        inference_thresholds = [job['threshold'] for job in pending]
+
+    claims = [None] * len(pending)
+    if ENABLE_REQUEST_COALESCING:
+        for index, job in enumerate(pending):
+            key = (job['pixel_key'] or VerdictCache.pixel_key(job['img_np']), inference_thresholds[index])
+            claims[index] = (key,) + in_flight_detections.claim(key)
+    leaders = [index for index, claim in enumerate(claims) if claim is None or claim[2]]
+
+    outcomes = [None] * len(pending)
+    leader_jobs = [pending[index] for index in leaders]
+    leader_thresholds = [inference_thresholds[index] for index in leaders]
+    try:
+        leader_outcomes = detect_many([job['img_np'] for job in leader_jobs], leader_thresholds)
+        leader_outcomes = refine_with_tiles(leader_jobs, leader_outcomes, leader_thresholds)
+    except Exception as e:
+        # Followers are waiting on these, so a failure still has to settle every claim
+        leader_outcomes = [e] * len(leaders)
+    for index, outcome in zip(leaders, leader_outcomes):
+        outcomes[index] = outcome
+        if claims[index] is not None:
+            in_flight_detections.settle(claims[index][0], outcome)
+    for index, claim in enumerate(claims):
+        if claim is not None and not claim[2]:
+            try:
+                outcomes[index] = wait_for_detections(claim[1])
+            except Exception as e:
+                outcomes[index] = e
+
+    # Every image in the pass waited for all of it, queueing included
+    elapsed = time.perf_counter_ns() - clock
+    for job in pending:
+        job['timings']['inference'] = job['timings'].get('inference', 0) + elapsed
+    for index, (job, outcome) in enumerate(zip(pending, outcomes)):
+        job['raw_detections'] = outcome
+        # The leader already cached and verified this result
+        is_leader = claims[index] is None or claims[index][2]
+        if is_leader and verdict_cache is not None and not isinstance(outcome, Exception):
+            verdict_cache.put(job['pixel_key'], job['raw_key'], outcome, job['shape'], job['phash'])
+            if job['near_check'] is not None:
+                reused_nsfw = check_nsfw(job['near_check'], job['threshold'])[0]
+                actual_nsfw = check_nsfw(outcome, job['threshold'])[0]
+                verdict_cache.record_near_check(reused_nsfw != actual_nsfw)
+
+    results = []
+    for job in jobs:
+        raw = job['raw_detections']
+        if isinstance(raw, Exception):
+            results.append(raw)
+        else:
+            results.append([d for d in raw if d['confidence'] >= job['threshold']])
+    return results
+
+
 app = Flask(__name__)
 CORS(app)
 
@@ -124,13 +1296,209 @@ SITE_SPECIFIC_RULES = [
     }
 ]
 
-def get_next_image_number(directory):
-    existing_files = [f for f in os.listdir(directory) if f.endswith(('.jpg', '.jpeg', '.png'))]
-    numbers = [int(f.split('.')[0]) for f in existing_files if f.split('.')[0].isdigit()]
+COMPILED_SITE_RULES = [(re.compile(rule['pattern']), re.compile(rule['title_pattern'])) for rule in SITE_SPECIFIC_RULES]
+
+@functools.lru_cache(maxsize=CONTEXT_CACHE_SIZE)
+def match_site_rule(url, title):
+    # Index of the first SITE_SPECIFIC_RULES entry matching the page, or None.
+    # Memoized, so every image after the first on a page costs a dictionary lookup.
+    for index, (url_regex, title_regex) in enumerate(COMPILED_SITE_RULES):
+        if (url and url_regex.search(url)) or (title and title_regex.search(title)):
+            return index
+    return None
+
+@functools.lru_cache(maxsize=CONTEXT_CACHE_SIZE)
+def find_unsafe_keyword(text):
+    # (keyword, index of the UNSAFE_CONTEXT_PATTERNS entry it belongs to), or None
+    match = UNSAFE_CONTEXT_REGEX.search(text)
+    if match is None:
+        return None
+    return match.group(0), int(match.lastgroup[len('group'):])
+
+# Confidence the model runs at when its detections are cached, low enough for every threshold above
+RAW_DETECTION_CONF = min([DEFAULT_NSFW_THRESHOLD, UNSAFE_WORD_THRESHOLD] + [rule['threshold'] for rule in SITE_SPECIFIC_RULES])
+
+def get_next_image_number(*directories):
+    # One past the highest number used by any file in the directories, whatever its
+    # extension, so a restart never hands out a number that is already on disk
+    numbers = [int(f.split('.')[0]) for directory in directories if os.path.isdir(directory)
+               for f in os.listdir(directory) if f.split('.')[0].isdigit()]
     return max(numbers) + 1 if numbers else 1
 
-def is_thumbnail(image):
-    return image.shape[0] < 128 or image.shape[1] < 128
+class ImageArchiver:
+    # Saves request images off the request path. File numbers come from an in-memory
+    # counter per category, seeded once from the archive at startup. The original is
+    # written exactly as it was uploaded (no re-encode), and the sfw/nsfw copy is a
+    # hardlink to it, or a manifest line where the filesystem has no hardlinks.
+    def __init__(self, base_dir, queue_size, full_policy):
+        self.base_dir = base_dir
+        self.full_policy = full_policy
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.next_numbers = {
+            category: get_next_image_number(*(os.path.join(base_dir, category, folder) for folder in ("original", "sfw", "nsfw")))
+            for category in ['images', 'thumbnails']
+        }
+        self.written = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name="image-archiver", daemon=True)
+        self.thread.start()
+
+    def submit(self, image_bytes, image_extension, category, target_folder):
+        # Reserves a file number and queues the write; returns the paths it will have,
+        # or (None, None) if the queue is full and the policy is 'drop'
+        with self.lock:
+            number = self.next_numbers[category]
+            self.next_numbers[category] += 1
+        original_path = os.path.join(self.base_dir, category, "original", f"{number}.{image_extension}")
+        target_path = os.path.join(self.base_dir, category, target_folder, f"{number}.{image_extension}")
+        task = (image_bytes, original_path, target_path)
+        if self.full_policy == 'block':
+            self.queue.put(task)
+        else:
+            try:
+                self.queue.put_nowait(task)
+            except queue.Full:
+                self.dropped += 1
+                return None, None
+        return original_path, target_path
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            image_bytes, original_path, target_path = task
+            try:
+                # 'x' refuses to overwrite: a numbering mistake must never clobber an archived
+                # image, or the categorized hardlink that shares its inode
+                with open(original_path, 'xb') as f:
+                    f.write(image_bytes)
+                try:
+                    os.link(original_path, target_path)
+                except OSError as e:
+                    if e.errno not in (errno.EPERM, errno.EXDEV, errno.ENOTSUP):
+                        raise
+                    manifest_path = os.path.join(os.path.dirname(target_path), "manifest.csv")
+                    with open(manifest_path, 'a') as f:
+                        f.write(f"{os.path.basename(target_path)},{original_path}\n")
+                self.written += 1
+            except OSError as e:
+                print(f"Error archiving image {original_path}: {e}")
+
+    def close(self):
+        # Drains queued writes; registered with atexit
+        self.queue.put(None)
+        self.thread.join(timeout=30)
+
+def is_thumbnail(shape):
+    return shape[0] < 128 or shape[1] < 128
+
+class DecodeBufferPool:
+    # Reusable pixel buffers for downscaled decodes, in two size classes: one model input
+    # and the largest image kept for tiling, of which far fewer are kept so a burst of
+    # large images does not pin hundreds of MB. Arrays handed out are views into a pooled
+    # buffer and go back with release(); one never released is simply garbage collected.
+    def __init__(self, max_buffers, max_large_buffers):
+        self.max_buffers = max_buffers
+        self.max_large_buffers = max_large_buffers
+        self.free = defaultdict(list)  # capacity -> [buffer]
+        self.owned = weakref.WeakValueDictionary()  # id(buffer) -> buffer, for every buffer handed out
+        self.lock = threading.Lock()
+        self.allocations = 0
+        self.reuses = 0
+
+    def acquire(self, height, width):
+        imgsz = get_model_input_size()
+        needed = height * width * 3
+        capacity = next(c for c in (imgsz * imgsz * 3, TILE_MAX_UPLOAD_SIDE * TILE_MAX_UPLOAD_SIDE * 3, needed) if c >= needed)
+        with self.lock:
+            buffer = self.free[capacity].pop() if self.free[capacity] else None
+            if buffer is None:
+                self.allocations += 1
+            else:
+                self.reuses += 1
+        if buffer is None:
+            buffer = np.empty(capacity, dtype=np.uint8)
+        with self.lock:
+            self.owned[id(buffer)] = buffer
+        return buffer[:needed].reshape(height, width, 3)
+
+    def release(self, img_np):
+        # Anything not handed out by acquire() (cache hits, small images, PIL decodes) is ignored,
+        # checked by identity, before anything is read from the base (for PIL it is a bytes object)
+        buffer = getattr(img_np, 'base', None)
+        with self.lock:
+            if buffer is None or self.owned.pop(id(buffer), None) is not buffer:
+                return
+        imgsz = get_model_input_size()
+        if buffer.size == imgsz * imgsz * 3:
+            keep = self.max_buffers
+        elif buffer.size == TILE_MAX_UPLOAD_SIDE * TILE_MAX_UPLOAD_SIDE * 3:
+            keep = self.max_large_buffers
+        else:
+            keep = 0
+        with self.lock:
+            if len(self.free[buffer.size]) < keep:
+                self.free[buffer.size].append(buffer)
+
+decode_buffers = DecodeBufferPool(DECODE_POOL_BUFFERS, DECODE_POOL_LARGE_BUFFERS)
+
+def decode_target_side(height, width):
+    # Longest side worth decoding: the model input, or for images that will be tiled the
+    # largest side the tiled pass works on
+    imgsz = get_model_input_size()
+    if ENABLE_TILED_INFERENCE and max(height, width) > imgsz * TILE_MAX_DOWNSCALE:
+        return min(max(height, width), TILE_MAX_UPLOAD_SIDE)
+    return min(max(height, width), imgsz)
+
+def decode_image(image_bytes):
+    # Decodes straight to the size the model will use, so peak memory follows the model
+    # input rather than the source resolution (for JPEG, whose decoder can skip detail).
+    # Only the header is read to plan the decode; JPEGs are then decoded at 1/2, 1/4 or
+    # 1/8 scale, and the one resize left writes into a pooled buffer. Returns the RGB
+    # pixels and the source (height, width, 3), which is what thumbnail checks look at.
+    try:
+        header = Image.open(BytesIO(image_bytes))
+        width, height = header.size
+    except Exception as e:
+        raise ValueError(f"Error processing image: {str(e)}")
+    target = decode_target_side(height, width)
+    shrink = max(height, width) / target
+
+    flags = cv2.IMREAD_COLOR
+    if header.format == 'JPEG':
+        for factor, reduced in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+            if factor <= shrink:
+                flags = reduced
+                break
+    # The colour decoders drop alpha and expand grayscale as they go
+    decoded = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), flags)
+    if decoded is None:
+        # Formats OpenCV cannot read (e.g. GIF) go through PIL instead
+        try:
+            header.draft('RGB', (max(1, int(width / shrink)), max(1, int(height / shrink))))
+            image = header.convert('RGB')
+            if max(image.size) > target:
+                scale = target / max(image.size)
+                image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.BOX)
+        except Exception as e:
+            raise ValueError(f"Error processing image: {str(e)}")
+        return np.array(image), (height, width, 3)
+
+    decoded_height, decoded_width = decoded.shape[:2]
+    if (decoded_height > decoded_width) != (height > width):
+        # OpenCV applied the EXIF orientation the header size does not include
+        height, width = width, height
+    if max(decoded_height, decoded_width) > target:
+        scale = target / max(decoded_height, decoded_width)
+        size = (max(1, round(decoded_width * scale)), max(1, round(decoded_height * scale)))
+        img_np = decode_buffers.acquire(size[1], size[0])
+        cv2.resize(decoded, size, dst=img_np, interpolation=cv2.INTER_AREA)
+    else:
+        img_np = decoded
+    cv2.cvtColor(img_np, cv2.COLOR_BGR2RGB, dst=img_np)
+    return img_np, (height, width, 3)
 
 def process_base64_image(base64_image):
     if ',' in base64_image:
@@ -148,165 +1516,762 @@ def process_base64_image(base64_image):
         base64_data += '=' * (4 - padding)
     try:
         decoded_image = base64.b64decode(base64_data)
-        image = Image.open(BytesIO(decoded_image))
-        image_extension = "jpg" if image_format in ["jpeg", "jpg"] else image_format
-
-        image_np = np.array(image)
-
-        if len(image_np.shape) == 2:
-            image_np = cv2.cvtColor(image_np, cv2.COLOR_GRAY2RGB)
-        elif image_np.shape[-1] == 4:
-            image_np = cv2.cvtColor(image_np, cv2.COLOR_RGBA2RGB)
-        elif image_np.shape[-1] != 3:
-            raise ValueError("Invalid image format")
-        return image_np, image_extension
+        img_np, shape = decode_image(decoded_image)
     except Exception as e:
         raise ValueError(f"Error processing base64 image: {str(e)}")
+    image_extension = "jpg" if image_format in ["jpeg", "jpg"] else image_format
+    return img_np, image_extension, decoded_image, shape
+
+@app.route('/config', methods=['GET'])
+def config():
+    # Lets the extension downscale images to what the model will actually see before uploading
+    config = {
+        'model_input_size': get_model_input_size(),
+        'min_image_side': 128
+    }
+    if ENABLE_TILED_INFERENCE:
+        # Images the letterbox would shrink too far may come up larger, to be tiled here
+        config['tile_trigger_side'] = int(config['model_input_size'] * TILE_TRIGGER_DOWNSCALE)
+        config['tile_upload_side'] = int(config['model_input_size'] * TILE_MAX_DOWNSCALE)
+        config['max_upload_side'] = TILE_MAX_UPLOAD_SIDE
+    return jsonify(config)
+
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Prometheus text exposition: stage latency histograms, counters and queue depths
+    lines = [
+        "# HELP erax_stage_seconds Time spent in each request stage",
+        "# TYPE erax_stage_seconds histogram",
+    ]
+    for stage, histogram in list(stage_metrics.histograms.items()):
+        with histogram.lock:
+            counts, total, count = list(histogram.counts), histogram.sum, histogram.count
+        label = prometheus_label(stage)
+        cumulative = 0
+        for bound, bucket_count in zip(list(histogram.buckets) + ['+Inf'], counts):
+            cumulative += bucket_count
+            lines.append(f'erax_stage_seconds_bucket{{stage="{label}",le="{bound}"}} {cumulative}')
+        lines.append(f'erax_stage_seconds_sum{{stage="{label}"}} {total}')
+        lines.append(f'erax_stage_seconds_count{{stage="{label}"}} {count}')
+
+    lines += ["# HELP erax_images_processed_total Images answered with a verdict",
+              "# TYPE erax_images_processed_total counter",
+              f"erax_images_processed_total {total_images_processed}",
+              "# HELP erax_coalesced_requests_total Images that shared an identical in-flight image's forward pass",
+              "# TYPE erax_coalesced_requests_total counter",
+              f"erax_coalesced_requests_total {in_flight_detections.coalesced}",
+              "# HELP erax_decode_buffers_total Pooled decode buffers by how they were obtained",
+              "# TYPE erax_decode_buffers_total counter",
+              f'erax_decode_buffers_total{{source="allocated"}} {decode_buffers.allocations}',
+              f'erax_decode_buffers_total{{source="reused"}} {decode_buffers.reuses}',
+              "# HELP erax_category_total Requests per category, rule and trigger",
+              "# TYPE erax_category_total counter"]
+    for category, count in list(category_stats.items()):
+        lines.append(f'erax_category_total{{category="{prometheus_label(category)}"}} {count}')
+
+    if verdict_cache is not None:
+        lines += ["# HELP erax_verdict_cache_lookups_total Verdict cache lookups by outcome",
+                  "# TYPE erax_verdict_cache_lookups_total counter"]
+        for outcome, count in (('raw_hit', verdict_cache.raw_hits), ('pixel_hit', verdict_cache.pixel_hits),
+                               ('near_hit', verdict_cache.near_hits), ('miss', verdict_cache.misses)):
+            lines.append(f'erax_verdict_cache_lookups_total{{outcome="{outcome}"}} {count}')
+        lines += ["# TYPE erax_verdict_cache_evictions_total counter",
+                  f"erax_verdict_cache_evictions_total {verdict_cache.evictions}",
+                  "# TYPE erax_verdict_cache_entries gauge",
+                  f"erax_verdict_cache_entries {len(verdict_cache.entries)}"]
+
+    depths = {'page_sessions': len(page_sessions.sessions), 'video_streams': len(video_streams.streams),
+              'escalated_domains': len(domain_escalations.expiry), 'tracked_domains': len(domain_stats.rows)}
+    if batcher is not None:
+        depths['batcher'] = batcher.queue.qsize()
+    if worker_pool is not None:
+        depths['worker_tasks'] = len(worker_pool.pending)
+        depths['worker_free_slots'] = worker_pool.free_slots.qsize()
+    if archiver is not None:
+        depths['archiver'] = archiver.queue.qsize()
+    if asgi_bridge is not None:
+        depths['asgi_admitted'] = asgi_bridge.admitted
+    lines += ["# HELP erax_queue_depth Items currently waiting or held in each queue and store",
+              "# TYPE erax_queue_depth gauge"]
+    for name, depth in depths.items():
+        lines.append(f'erax_queue_depth{{queue="{name}"}} {depth}')
+
+    return app.response_class("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
+
+def cors_preflight_response():
+    response = jsonify({"status": "ok"})
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    response.headers.add("Access-Control-Allow-Methods", "POST, OPTIONS")
+    response.headers.add("Access-Control-Allow-Headers", "Content-Type, X-Predict-Meta")
+    response.headers.add("Access-Control-Allow-Private-Network", "true")
+    return response, 200
+
+class SessionExpiredError(ValueError):
+    pass
+
+class PageSessionStore:
+    # Context resolved once per page: the extension registers URL, title and high-risk
+    # flag, and image requests then carry only the session id. Sessions expire after
+    # ttl_seconds without use; the least recently used are dropped beyond max_sessions.
+    def __init__(self, ttl_seconds, max_sessions):
+        self.ttl = ttl_seconds
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def create(self, source_url, page_title, high_risk):
+        if high_risk:
+            threshold, category = UNSAFE_WORD_THRESHOLD, 'High-Risk Session'
+        else:
+            threshold = get_site_specific_threshold(source_url, page_title)
+            rule_index = match_site_rule(source_url, page_title) if ENABLE_DOMAIN_RULES else None
+            category = SITE_SPECIFIC_RULES[rule_index]['category'] if rule_index is not None else 'Default'
+        session_id = secrets.token_urlsafe(12)
+        session = {'source_url': source_url, 'page_title': page_title, 'high_risk': bool(high_risk),
+                   'threshold': threshold, 'category': category, 'expires': time.time() + self.ttl}
+        with self.lock:
+            self.sessions[session_id] = session
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return session_id, session
+
+    def get(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return None
+            now = time.time()
+            if now > session['expires']:
+                del self.sessions[session_id]
+                return None
+            session['expires'] = now + self.ttl
+            self.sessions.move_to_end(session_id)
+            return session
+
+page_sessions = PageSessionStore(PAGE_SESSION_TTL_SECONDS, PAGE_SESSION_MAX)
+
+@app.route('/session', methods=['POST', 'OPTIONS'])
+def register_session():
+    if request.method == 'OPTIONS':
+        return cors_preflight_response()
+    data = request.json or {}
+    session_id, session = page_sessions.create(data.get('source_url', 'unknown'), data.get('page_title', ''),
+                                               data.get('high_risk', False))
+    return jsonify({
+        'session_id': session_id, 'threshold': session['threshold'], 'category': session['category'],
+        'expires_in': page_sessions.ttl
+    })
+
+class DomainEscalations:
+    # Domains flagged high-risk by a confident detection or an unsafe keyword. Later
+    # requests from an escalated domain get UNSAFE_WORD_THRESHOLD automatically until
+    # ttl_seconds pass without another trigger. Owned here so concurrent tabs never race.
+    def __init__(self, ttl_seconds, max_domains):
+        self.ttl = ttl_seconds
+        self.max_domains = max_domains
+        self.expiry = OrderedDict()
+        self.lock = threading.Lock()
+
+    def escalate(self, domain):
+        if not domain or domain == 'unknown':
+            return
+        with self.lock:
+            newly = domain not in self.expiry or time.time() > self.expiry[domain]
+            self.expiry[domain] = time.time() + self.ttl
+            self.expiry.move_to_end(domain)
+            while len(self.expiry) > self.max_domains:
+                self.expiry.popitem(last=False)
+        if newly:
+            category_stats['Domain Escalations'] += 1
+            print(f"Escalating site to high-risk: {domain}")
+
+    def is_escalated(self, domain):
+        with self.lock:
+            expires = self.expiry.get(domain)
+            if expires is None:
+                return False
+            if time.time() > expires:
+                del self.expiry[domain]
+                return False
+            return True
+
+domain_escalations = DomainEscalations(ESCALATION_TTL_SECONDS, ESCALATION_MAX_DOMAINS)
+
+class DomainStatsStore:
+    # Verdict history per domain in preallocated arrays, one row per domain: verdict and
+    # NSFW counts, the current SFW streak, an EMA of the NSFW rate and a histogram of each
+    # verdict's top NSFW confidence. Rows of the least recently seen domains are reused
+    # once max_domains are tracked. Feeds adaptive_threshold() and can_skip().
+    def __init__(self, max_domains, bins):
+        self.bins = bins
+        self.rows = OrderedDict()  # domain -> row, least recently seen first
+        self.free_rows = list(range(max_domains - 1, -1, -1))
+        self.totals = np.zeros(max_domains, dtype=np.int64)
+        self.nsfw = np.zeros(max_domains, dtype=np.int64)
+        self.clean_streak = np.zeros(max_domains, dtype=np.int64)
+        self.recent_rate = np.zeros(max_domains, dtype=np.float32)
+        self.histograms = np.zeros((max_domains, bins), dtype=np.uint32)
+        self.last_seen = np.zeros(max_domains, dtype=np.float64)
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def _row(self, domain):
+        row = self.rows.get(domain)
+        if row is not None:
+            self.rows.move_to_end(domain)
+            return row
+        if self.free_rows:
+            row = self.free_rows.pop()
+        else:
+            _, row = self.rows.popitem(last=False)
+            self.evictions += 1
+        for column in (self.totals, self.nsfw, self.clean_streak, self.recent_rate, self.histograms, self.last_seen):
+            column[row] = 0
+        self.rows[domain] = row
+        return row
+
+    def record(self, domain, confidence, is_nsfw):
+        if not domain or domain == 'unknown':
+            return
+        bin_index = min(self.bins - 1, int(confidence * self.bins))
+        with self.lock:
+            row = self._row(domain)
+            self.totals[row] += 1
+            self.histograms[row, bin_index] += 1
+            if is_nsfw:
+                self.nsfw[row] += 1
+                self.clean_streak[row] = 0
+            else:
+                self.clean_streak[row] += 1
+            self.recent_rate[row] += DOMAIN_RATE_ALPHA * (float(is_nsfw) - self.recent_rate[row])
+            self.last_seen[row] = time.time()
+
+    def _risk(self, row):
+        # 0 for a clean or little-known domain, 1 at DOMAIN_RISKY_RATE and above
+        if self.totals[row] < DOMAIN_MIN_SAMPLES:
+            return 0.0
+        return min(1.0, float(self.recent_rate[row]) / DOMAIN_RISKY_RATE)
+
+    def adaptive_threshold(self, domain, threshold):
+        # Lowers the threshold in proportion to the domain's risk, reaching
+        # UNSAFE_WORD_THRESHOLD at DOMAIN_RISKY_RATE. Never raises it, and never goes below
+        # RAW_DETECTION_CONF, the confidence cached detections were kept down to.
+        with self.lock:
+            row = self.rows.get(domain)
+            risk = self._risk(row) if row is not None else 0.0
+        floor = max(UNSAFE_WORD_THRESHOLD, RAW_DETECTION_CONF)
+        if threshold <= floor:
+            return threshold
+        return threshold - risk * (threshold - floor)
+
+    def can_skip(self, domain):
+        with self.lock:
+            row = self.rows.get(domain)
+            return row is not None and self.clean_streak[row] >= DOMAIN_SKIP_CLEAN_STREAK
+
+    def snapshot(self, domain=None, limit=100):
+        # Per-domain history for analysis, busiest domains first
+        with self.lock:
+            if domain:
+                rows = [(domain, self.rows[domain])] if domain in self.rows else []
+            else:
+                rows = sorted(self.rows.items(), key=lambda item: -int(self.totals[item[1]]))[:limit]
+            return [{
+                'domain': name, 'verdicts': int(self.totals[row]), 'nsfw': int(self.nsfw[row]),
+                'clean_streak': int(self.clean_streak[row]), 'recent_nsfw_rate': round(float(self.recent_rate[row]), 4),
+                'risk': round(self._risk(row), 4), 'skips_model': bool(self.clean_streak[row] >= DOMAIN_SKIP_CLEAN_STREAK),
+                'confidence_histogram': self.histograms[row].tolist(), 'last_seen': float(self.last_seen[row]),
+            } for name, row in rows]
+
+domain_stats = DomainStatsStore(DOMAIN_STATS_MAX, DOMAIN_HISTOGRAM_BINS)
+
+@app.route('/domain_stats', methods=['GET'])
+def get_domain_stats():
+    # ?domain=<host> for one domain, otherwise the busiest ?limit=<n> (default 100)
+    limit = request.args.get('limit', default=100, type=int)
+    return jsonify({
+        'domains': domain_stats.snapshot(request.args.get('domain'), limit),
+        'tracked': len(domain_stats.rows), 'evictions': domain_stats.evictions
+    })
+
+class VideoStreamStore:
+    # Temporal state for videos sampled frame by frame. Each stream keeps an exponential
+    # moving average of its frame confidences and a blur decision with hysteresis: it
+    # blurs once the average reaches the threshold and only clears again below
+    # threshold * STREAM_UNBLUR_RATIO, so a borderline scene does not flicker.
+    def __init__(self, ttl_seconds, max_streams, alpha, unblur_ratio):
+        self.ttl = ttl_seconds
+        self.max_streams = max_streams
+        self.alpha = alpha
+        self.unblur_ratio = unblur_ratio
+        self.streams = OrderedDict()
+        self.lock = threading.Lock()
+
+    def update(self, stream_id, confidence, threshold):
+        # Folds one frame into its stream, starting a new stream when the id is unknown or
+        # expired. Returns (stream_id, stream state snapshot, whether the decision changed).
+        with self.lock:
+            now = time.time()
+            stream = self.streams.get(stream_id) if stream_id else None
+            if stream is None or now > stream['expires']:
+                stream_id = secrets.token_urlsafe(12)
+                stream = {'ema': confidence, 'blur': False, 'frames': 0}
+                self.streams[stream_id] = stream
+            else:
+                stream['ema'] = self.alpha * confidence + (1 - self.alpha) * stream['ema']
+            stream['frames'] += 1
+            stream['expires'] = now + self.ttl
+            self.streams.move_to_end(stream_id)
+            while len(self.streams) > self.max_streams:
+                self.streams.popitem(last=False)
+
+            was_blurred = stream['blur']
+            if was_blurred:
+                stream['blur'] = stream['ema'] >= threshold * self.unblur_ratio
+            else:
+                stream['blur'] = stream['ema'] >= threshold
+            return stream_id, dict(stream), stream['blur'] != was_blurred
+
+video_streams = VideoStreamStore(STREAM_TTL_SECONDS, STREAM_MAX, STREAM_EMA_ALPHA, STREAM_UNBLUR_RATIO)
+
+record_lock = threading.Lock()
+
+def record_request(data, session):
+    # Captures a request body for offline replay: binary uploads become data URLs and the
+    # page context is resolved from the session, which will be long gone at replay time
+    body = {key: value for key, value in data.items() if key not in ('image_bytes', 'session_id')}
+    if data.get('image_bytes'):
+        extension = sniff_image_extension(data['image_bytes'])
+        body['base64_image'] = f"data:image/{extension};base64," + base64.b64encode(data['image_bytes']).decode('ascii')
+    if session is not None:
+        body['source_url'], body['page_title'] = session['source_url'], session['page_title']
+    body['recorded_at'] = time.time()
+    with record_lock, open(RECORD_REQUESTS_PATH, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(body) + "\n")
+
+def prepare_prediction(data, timings=None):
+    # Decodes the image and resolves the threshold for one request body.
+    # The image is either a base64 data URL or, from /predict_binary, raw 'image_bytes'.
+    # Page context comes from a registered 'session_id' or, without one, from the body.
+    # Raises ValueError when the body carries no usable image, and SessionExpiredError
+    # when its session is unknown so the extension can register the page again.
+    # Per-stage times go into the job's 'timings' (nanoseconds) for metrics and headers,
+    # after any the caller already measured.
+    timings = {} if timings is None else timings
+    clock = time.perf_counter_ns()
+    image_bytes = data.get('image_bytes')
+    base64_image = image_bytes or data.get('base64_image', '')
+    source_url = data.get('source_url', 'unknown')
+    page_title = data.get('page_title', '')
+    alt_text = data.get('alt_text', '').lower()
+    caption = data.get('caption', '').lower()
+    # <<< CHANGE 1: Check for escalation status from the extension
+    use_low_threshold = data.get('use_low_threshold', False)
+
+    if not base64_image:
+        raise ValueError("No image data provided")
+
+    session = None
+    if data.get('session_id'):
+        session = page_sessions.get(data['session_id'])
+        if session is None:
+            raise SessionExpiredError("session_expired")
+        source_url = session['source_url']
+    if RECORD_REQUESTS_PATH:
+        record_request(data, session)
+
+    img_np, image_extension, encoded_image, shape, raw_detections = None, None, None, None, None
+    raw_key, pixel_key, phash, near_check = None, None, None, None
+    clock = lap(timings, 'context', clock)
+    if verdict_cache is not None:
+        raw_key = verdict_cache.raw_key(base64_image)
+        cached = verdict_cache.get_by_raw(raw_key)
+        if cached is not None:
+            raw_detections, shape = cached[0], cached[1]
+        clock = lap(timings, 'cache_lookup', clock)
+
+    if raw_detections is None:
+        if image_bytes:
+            img_np, image_extension, shape = process_image_bytes(image_bytes)
+            encoded_image = image_bytes
+        else:
+            img_np, image_extension, encoded_image, shape = process_base64_image(base64_image)
+        clock = lap(timings, 'decode', clock)
+        if verdict_cache is not None:
+            pixel_key = verdict_cache.pixel_key(img_np)
+            cached = verdict_cache.get_by_pixels(pixel_key, raw_key)
+            if cached is not None:
+                raw_detections = cached[0]
+            elif verdict_cache.near_duplicates:
+                phash = dhash(img_np)
+                cached = verdict_cache.get_near(phash)
+                if cached is not None:
+                    # A small sample still goes to the model to measure how often reuse is wrong
+                    if random.random() < PHASH_VERIFY_SAMPLE_RATE:
+                        near_check = cached[0]
+                    else:
+                        raw_detections = cached[0]
+            clock = lap(timings, 'cache_lookup', clock)
+
+    if use_low_threshold:
+        threshold = UNSAFE_WORD_THRESHOLD 
+    elif session is not None:
+        threshold = session['threshold']
+    else:
+        threshold = get_site_specific_threshold(source_url, page_title)
+    
+    escalated = domain_escalations.is_escalated(source_url)
+    if escalated:
+        threshold = min(threshold, UNSAFE_WORD_THRESHOLD)
+    
+    escalate_flag = False
+
+    if ENABLE_UNSAFE_WORD_CHECK:
+        text_context = alt_text + " " + caption
+        found = find_unsafe_keyword(text_context)
+        if found:
+            found_unsafe_word, pattern_index = found
+            threshold = min(threshold, UNSAFE_WORD_THRESHOLD)
+            
+            escalate_flag = True
+            print(f"Unsafe keyword '{found_unsafe_word}' (group {pattern_index}) found via regex. Lowering threshold to {threshold} and escalating.")
+            category_stats['Unsafe Word Trigger'] += 1
+    # The domain's history is judged at the threshold it would have had without that
+    # history, so a lowered threshold cannot raise the NSFW rate that lowered it
+    base_threshold = threshold
+    if ENABLE_ADAPTIVE_DOMAINS:
+        threshold = domain_stats.adaptive_threshold(source_url, threshold)
+    clock = lap(timings, 'context', clock)
+
+    # Cache misses from domains with a long clean history, or that are obviously safe,
+    # skip the model. Their empty verdict is not cached, since a lower threshold later on
+    # might not have skipped them.
+    cached = raw_detections is not None
+    domain_skipped = False
+    if (ENABLE_ADAPTIVE_DOMAINS and not cached and near_check is None and not escalate_flag and not escalated
+            and domain_stats.can_skip(source_url) and random.random() >= DOMAIN_SKIP_SAMPLE_RATE):
+        raw_detections, domain_skipped = [], True
+        category_stats['Domain Fast Path'] += 1
+    prefiltered = False
+    if ENABLE_SAFE_PREFILTER and not cached and not domain_skipped and near_check is None and is_confidently_safe(img_np, threshold):
+        raw_detections, prefiltered = [], True
+        category_stats['Pre-filter Skips'] += 1
+    if ENABLE_SAFE_PREFILTER and not cached:
+        lap(timings, 'prefilter', clock)
+
+    return {
+        'img_np': img_np, 'image_extension': image_extension, 'encoded_image': encoded_image, 'source_url': source_url,
+        'threshold': threshold, 'base_threshold': base_threshold, 'escalate': escalate_flag, 'escalated': escalated, 'shape': shape,
+        'raw_key': raw_key, 'pixel_key': pixel_key, 'raw_detections': raw_detections,
+        'phash': phash, 'near_check': near_check, 'cached': cached, 'prefiltered': prefiltered,
+        'domain_skipped': domain_skipped, 'timings': timings
+    }
+
+def finish_prediction(job, detections, start_time):
+    # Turns the detections for a prepared request into its JSON verdict and archives the image
+    global total_images_processed
+    image_extension = job['image_extension']
+    source_url = job['source_url']
+    threshold = job['threshold']
+    escalate_flag = job['escalate']
+
+    is_nsfw, highest_conf, detected_class = check_nsfw(detections, threshold)
+
+    
+    if highest_conf > 0.5:
+         escalate_flag = True
+    if escalate_flag:
+        domain_escalations.escalate(source_url)
+    # Only fresh model verdicts count towards the domain's history: cache hits would let
+    # one repeated logo build a clean streak on its own
+    if ENABLE_ADAPTIVE_DOMAINS and not job['cached'] and not job['prefiltered'] and not job['domain_skipped']:
+        domain_stats.record(source_url, highest_nsfw_detection(job['raw_detections'])[0],
+                            check_nsfw(job['raw_detections'], job['base_threshold'])[0])
+    
+    is_thumb = is_thumbnail(job['shape'])
+    category = "thumbnails" if is_thumb else "images"
+    
+    # Cache hits were archived the first time they were seen
+    original_path, target_path = None, None
+    if not job['cached'] and archiver is not None:
+        clock = time.perf_counter_ns()
+        target_folder = "nsfw" if is_nsfw else "sfw"
+        original_path, target_path = archiver.submit(job['encoded_image'], image_extension, category, target_folder)
+        lap(job['timings'], 'archive', clock)
+    
+    total_images_processed += 1
+    processing_time = time.time() - start_time
+    timings_ms = record_timings(job['timings'], processing_time)
+    
+    if is_nsfw:
+        category_stats['NSFW'] += 1
+        print(f"NSFW detected ({detected_class} - {highest_conf:.2f}) - URL: {source_url} - Time: {processing_time:.2f}s")
+        return {
+            'prediction': 'NSFW', 'confidence': highest_conf, 'class': detected_class,
+            'regions': detection_regions(detections, threshold), 'region_scale': REGION_BOX_SCALE,
+            'processing_time': processing_time, 'timings_ms': timings_ms,
+            'escalate': escalate_flag, 'escalated': escalate_flag or job['escalated'],
+            'details': { 'nsfw_detected': True, 'category': category, 'threshold_used': threshold,
+                         'cached': job['cached'], 'prefiltered': job['prefiltered'], 'domain_skipped': job['domain_skipped'],
+                         'saved_paths': { 'original': original_path, 'categorized': target_path } }
+        }
+    else:
+        category_stats['SFW'] += 1
+        print(f"SFW image - URL: {source_url} - Time: {processing_time:.2f}s")
+        return {
+            'prediction': 'SFW', 'confidence': highest_conf, 'processing_time': processing_time, 'timings_ms': timings_ms,
+            'escalate': escalate_flag, 'escalated': escalate_flag or job['escalated'],
+            'details': { 'nsfw_detected': False, 'category': category, 'threshold_used': threshold,
+                         'cached': job['cached'], 'prefiltered': job['prefiltered'], 'domain_skipped': job['domain_skipped'],
+                         'saved_paths': { 'original': original_path, 'categorized': target_path } }
+        }
+
+def detection_regions(detections, threshold):
+    # Flagged boxes as [x1, y1, x2, y2] integers scaled to REGION_BOX_SCALE, most confident
+    # first. Verdicts cached before boxes were recorded have none.
+    flagged = sorted((d for d in detections if d['class'] in NSFW_CLASSES and d['confidence'] >= threshold and d.get('box')),
+                     key=lambda d: d['confidence'], reverse=True)
+    return [[int(round(v * REGION_BOX_SCALE)) for v in d['box']] for d in flagged[:MAX_REGIONS]]
+
+def record_timings(timings, processing_time):
+    # Feeds a request's stage times and total into the histograms; returns them in ms
+    stage_metrics.observe_timings(timings)
+    stage_metrics.observe('total', processing_time)
+    timings_ms = {stage: round(elapsed_ns / 1e6, 2) for stage, elapsed_ns in timings.items()}
+    timings_ms['total'] = round(processing_time * 1000, 2)
+    return timings_ms
+
+def timed_response(result):
+    # JSON response for one image with its stage times also in a Server-Timing header,
+    # which the extension can read next to its own blur timings
+    response = jsonify(result)
+    timings_ms = result.get('timings_ms')
+    if timings_ms:
+        response.headers['Server-Timing'] = ", ".join(f"{stage};dur={ms}" for stage, ms in timings_ms.items())
+        response.headers['Timing-Allow-Origin'] = "*"
+    return response
+
+def error_prediction(error, start_time):
+    processing_time = time.time() - start_time
+    print(f"Error processing image: {str(error)} - Time: {processing_time:.2f}s")
+    stage_metrics.observe('total', processing_time)
+    return { 'error': str(error), 'prediction': 'ERROR', 'processing_time': processing_time }
+
+def sniff_image_extension(image_bytes):
+    if image_bytes[:3] == b'\xff\xd8\xff':
+        return 'jpg'
+    if image_bytes[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+        return 'webp'
+    if image_bytes[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    return 'png'
+
+def process_image_bytes(image_bytes):
+    # Binary uploads skip base64 and go straight to the shared decode
+    img_np, shape = decode_image(image_bytes)
+    return img_np, sniff_image_extension(image_bytes), shape
 
 @app.route('/predict', methods=['POST', 'OPTIONS'])
 def predict():
-    global total_images_processed, processing_times
-    
     if request.method == 'OPTIONS':
-        response = jsonify({"status": "ok"})
-        response.headers.add("Access-Control-Allow-Origin", "*")
-        response.headers.add("Access-Control-Allow-Methods", "POST, OPTIONS")
-        response.headers.add("Access-Control-Allow-Headers", "Content-Type")
-        response.headers.add("Access-Control-Allow-Private-Network", "true")
-        return response, 200
+        return cors_preflight_response()
     
     start_time = time.time()
+    timings = {}
+    clock = time.perf_counter_ns()
+    job = None
     
     try:
-        data = request.json
-        base64_image = data.get('base64_image', '')
-        source_url = data.get('source_url', 'unknown')
-        page_title = data.get('page_title', '')
-        alt_text = data.get('alt_text', '').lower()
-        caption = data.get('caption', '').lower()
-        # <<< CHANGE 1: Check for escalation status from the extension
-        use_low_threshold = data.get('use_low_threshold', False)
-        
-        if not base64_image:
-            return jsonify({"error": "No image data provided"}), 400
-        
         try:
-            img_np, image_extension = process_base64_image(base64_image)
+            data = request.json
+            lap(timings, 'parse', clock)
+            job = prepare_prediction(data, timings)
         except ValueError as ve:
             return jsonify({"error": str(ve)}), 400
         except Exception as e:
             print(f"Error in image preprocessing: {e}")
             return jsonify({"error": str(e)}), 400
-        
-      
-        if use_low_threshold:
-            threshold = UNSAFE_WORD_THRESHOLD 
-        else:
-            threshold = get_site_specific_threshold(source_url, page_title)
-        
-        escalate_flag = False
-
-        if ENABLE_UNSAFE_WORD_CHECK:
-            text_context = alt_text + " " + caption
-            found_unsafe_word = None
-            for pattern in UNSAFE_CONTEXT_PATTERNS:
-                match = re.search(pattern, text_context, re.IGNORECASE)
-                if match:
-                    found_unsafe_word = match.group(0)
-                    threshold = min(threshold, UNSAFE_WORD_THRESHOLD)
-                    
-                    escalate_flag = True
-                    print(f"Unsafe keyword '{found_unsafe_word}' found via regex. Lowering threshold to {threshold} and escalating.")
-                    category_stats['Unsafe Word Trigger'] += 1
-                    break
 
+        detections = resolve_detections([job])[0]
+        if isinstance(detections, Exception):
+            raise detections
+        return timed_response(finish_prediction(job, detections, start_time))
+            
+    except Exception as e:
+        return jsonify(error_prediction(e, start_time))
+    finally:
+        if job is not None:
+            decode_buffers.release(job['img_np'])
+
+@app.route('/predict_batch', methods=['POST', 'OPTIONS'])
+def predict_batch():
+    # Same as /predict for a list of request bodies under 'items'; results come back
+    # in the same order, with per-item errors instead of failing the whole batch
+    if request.method == 'OPTIONS':
+        return cors_preflight_response()
+
+    start_time = time.time()
+    clock = time.perf_counter_ns()
+    data = request.json or {}
+    stage_metrics.observe('parse', (time.perf_counter_ns() - clock) / 1e9)
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "No items provided"}), 400
+    if len(items) > PREDICT_BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Too many items (max {PREDICT_BATCH_MAX_ITEMS})"}), 400
+
+    return jsonify({ 'results': predict_items(items, start_time), 'processing_time': time.time() - start_time })
+
+def predict_items(items, start_time):
+    results = [None] * len(items)
+    jobs = []
+    for index, item in enumerate(items):
         try:
-            with torch.no_grad():
-                results = model(img_np, conf=threshold, verbose=False)
-        except RuntimeError as e:
-            if "Cannot set version_counter for inference tensor" in str(e):
-                print("Handling inference tensor error - trying with CPU copy")
-                img_np_copy = img_np.copy()
-                results = model(img_np_copy, conf=threshold, verbose=False)
-            else:
-                raise
-        
-        detections = []
-        for result in results:
-            boxes = result.boxes
-            for i in range(len(boxes)):
-                cls_id = int(boxes.cls[i].item())
-                conf = boxes.conf[i].item()
-                cls_name = result.names[cls_id].upper()
-                detections.append({'class': cls_name, 'confidence': conf})
-        
-        is_nsfw, highest_conf, detected_class = check_nsfw(detections, threshold)
-
-        
-        if highest_conf > 0.5:
-             escalate_flag = True
-        
-        is_thumb = is_thumbnail(img_np)
-        category = "thumbnails" if is_thumb else "images"
-        
-        next_number = get_next_image_number(os.path.join(FULL_DIR, category, "original"))
-        
-        original_path = os.path.join(FULL_DIR, category, "original", f"{next_number}.{image_extension}")
-        cv2.imwrite(original_path, cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR))
-        
-        target_folder = "nsfw" if is_nsfw else "sfw"
-        target_path = os.path.join(FULL_DIR, category, target_folder, f"{next_number}.{image_extension}")
-        cv2.imwrite(target_path, cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR))
-        
-        total_images_processed += 1
+            jobs.append((index, prepare_prediction(item)))
+        except Exception as e:
+            results[index] = { 'error': str(e), 'prediction': 'ERROR' }
+
+    outcomes = resolve_detections([job for _, job in jobs])
+    for (index, job), outcome in zip(jobs, outcomes):
+        try:
+            if isinstance(outcome, Exception):
+                raise outcome
+            results[index] = finish_prediction(job, outcome, start_time)
+        except Exception as e:
+            results[index] = error_prediction(e, start_time)
+        finally:
+            decode_buffers.release(job['img_np'])
+
+    category_stats['Batch Requests'] += 1
+    return results
+
+@app.route('/predict_binary', methods=['POST', 'OPTIONS'])
+def predict_binary():
+    # Binary transport, no base64 anywhere:
+    #  - multipart/form-data: a 'meta' part holding a JSON list of request bodies without
+    #    images, and one file part per item named by its 'file' key (default 'image_<index>');
+    #    answered like /predict_batch
+    #  - any other content type: the body is the image itself and the request body fields
+    #    come as JSON in the X-Predict-Meta header; answered like /predict
+    if request.method == 'OPTIONS':
+        return cors_preflight_response()
+
+    start_time = time.time()
+    timings = {}
+    clock = time.perf_counter_ns()
+    if request.mimetype == 'multipart/form-data':
+        try:
+            items = json.loads(request.form.get('meta', '[]'))
+        except ValueError:
+            return jsonify({"error": "Invalid meta part"}), 400
+        if not isinstance(items, list) or not items:
+            return jsonify({"error": "No items provided"}), 400
+        if len(items) > PREDICT_BATCH_MAX_ITEMS:
+            return jsonify({"error": f"Too many items (max {PREDICT_BATCH_MAX_ITEMS})"}), 400
+        for index, item in enumerate(items):
+            upload = request.files.get(item.get('file', f"image_{index}"))
+            item['image_bytes'] = upload.read() if upload is not None else None
+        stage_metrics.observe('parse', (time.perf_counter_ns() - clock) / 1e9)
+        return jsonify({ 'results': predict_items(items, start_time), 'processing_time': time.time() - start_time })
+
+    try:
+        data = json.loads(request.headers.get('X-Predict-Meta', '{}'))
+    except ValueError:
+        return jsonify({"error": "Invalid X-Predict-Meta header"}), 400
+    data['image_bytes'] = request.get_data(cache=False)
+    lap(timings, 'parse', clock)
+    job = None
+    try:
+        try:
+            job = prepare_prediction(data, timings)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 400
+        detections = resolve_detections([job])[0]
+        if isinstance(detections, Exception):
+            raise detections
+        return timed_response(finish_prediction(job, detections, start_time))
+    except Exception as e:
+        return jsonify(error_prediction(e, start_time))
+    finally:
+        if job is not None:
+            decode_buffers.release(job['img_np'])
+
+def highest_nsfw_detection(detections):
+    # (confidence, class) of the most confident NSFW detection, or (0, None)
+    best = max((d for d in detections if d['class'] in NSFW_CLASSES), key=lambda d: d['confidence'], default=None)
+    return (best['confidence'], best['class']) if best is not None else (0, None)
+
+@app.route('/predict_stream', methods=['POST', 'OPTIONS'])
+def predict_stream():
+    # One sampled video frame as the raw request body, with the request body fields as
+    # JSON in the X-Predict-Meta header plus the 'stream_id' returned for the previous
+    # frame (omit it for the first one). Answers with the stream's smoothed blur
+    # decision rather than the frame's own verdict. Frames are never archived.
+    if request.method == 'OPTIONS':
+        return cors_preflight_response()
+
+    start_time = time.time()
+    timings = {}
+    clock = time.perf_counter_ns()
+    try:
+        data = json.loads(request.headers.get('X-Predict-Meta', '{}'))
+    except ValueError:
+        return jsonify({"error": "Invalid X-Predict-Meta header"}), 400
+    data['image_bytes'] = request.get_data(cache=False)
+    lap(timings, 'parse', clock)
+    job = None
+    try:
+        try:
+            job = prepare_prediction(data, timings)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 400
+        detections = resolve_detections([job])[0]
+        if isinstance(detections, Exception):
+            raise detections
+
+        # The average runs on the raw confidence so frames just under the threshold still count
+        confidence, detected_class = highest_nsfw_detection(job['raw_detections'])
+        stream_id, stream, changed = video_streams.update(data.get('stream_id'), confidence, job['threshold'])
+        if job['escalate'] or confidence > 0.5:
+            domain_escalations.escalate(job['source_url'])
+
         processing_time = time.time() - start_time
-        processing_times.append(processing_time)
-        
-        if is_nsfw:
-            category_stats['NSFW'] += 1
-            print(f"NSFW detected ({detected_class} - {highest_conf:.2f}) - URL: {source_url} - Time: {processing_time:.2f}s")
-            return jsonify({
-                'prediction': 'NSFW', 'confidence': highest_conf, 'class': detected_class,
-                'processing_time': processing_time,
-                'escalate': escalate_flag,
-                'details': { 'nsfw_detected': True, 'category': category, 'threshold_used': threshold,
-                             'saved_paths': { 'original': original_path, 'categorized': target_path } }
-            })
-        else:
-            category_stats['SFW'] += 1
-            print(f"SFW image - URL: {source_url} - Time: {processing_time:.2f}s")
-            return jsonify({
-                'prediction': 'SFW', 'confidence': highest_conf, 'processing_time': processing_time,
-                'escalate': escalate_flag,
-                'details': { 'nsfw_detected': False, 'category': category, 'threshold_used': threshold,
-                             'saved_paths': { 'original': original_path, 'categorized': target_path } }
-            })
-            
+        timings_ms = record_timings(job['timings'], processing_time)
+        category_stats['Video Frames'] += 1
+        if changed:
+            state = "blurred" if stream['blur'] else "cleared"
+            print(f"Video stream {stream_id} {state} (ema {stream['ema']:.2f}, frame {stream['frames']}) - URL: {job['source_url']}")
+        return timed_response({
+            'stream_id': stream_id, 'blur': stream['blur'], 'changed': changed,
+            'confidence': confidence, 'class': detected_class, 'ema': stream['ema'],
+            'threshold_used': job['threshold'], 'frames': stream['frames'], 'cached': job['cached'],
+            'processing_time': processing_time, 'timings_ms': timings_ms
+        })
     except Exception as e:
-        end_time = time.time()
-        processing_time = end_time - start_time
-        print(f"Error processing image: {str(e)} - Time: {processing_time:.2f}s")
-        processing_times.append(processing_time)
-        return jsonify({ 'error': str(e), 'prediction': 'ERROR', 'processing_time': processing_time })
+        return jsonify(error_prediction(e, start_time))
+    finally:
+        if job is not None:
+            decode_buffers.release(job['img_np'])
 
 def get_site_specific_threshold(url, title):
     if not ENABLE_DOMAIN_RULES:
         category_stats['Default (Domain Rules Disabled)'] += 1
         return DEFAULT_NSFW_THRESHOLD
 
-    threshold = DEFAULT_NSFW_THRESHOLD
-    
-    for rule in SITE_SPECIFIC_RULES:
-        url_match = re.search(rule['pattern'], url) if url else False
-        title_match = re.search(rule['title_pattern'], title) if title else False
-        
-        if url_match or title_match:
-            category_stats[rule['category']] += 1
-            print(f"Applied {rule['category']} threshold for {url}")
-            return rule['threshold']
+    rule_index = match_site_rule(url, title)
+    if rule_index is not None:
+        rule = SITE_SPECIFIC_RULES[rule_index]
+        category_stats[rule['category']] += 1
+        print(f"Applied {rule['category']} threshold for {url}")
+        return rule['threshold']
     
     category_stats['Default'] += 1
-    return threshold
+    return DEFAULT_NSFW_THRESHOLD
 
 def check_nsfw(detections, threshold):
     highest_conf = 0
@@ -324,7 +2289,319 @@ def check_nsfw(detections, threshold):
     
     return False, highest_conf, detected_class
 
+PREDICT_PATHS = ('/predict', '/predict_batch', '/predict_binary', '/predict_stream')
+
+class AsgiBridge:
+    # ASGI front end for the Flask app (--asgi): the event loop accepts connections and
+    # reads bodies while the Flask handlers run on a bounded thread pool. POSTs to the
+    # predict routes also pass admission control: at most admission_limit are admitted
+    # at once, and each has a deadline (REQUEST_DEADLINE_MS, or lower if the client sends
+    # X-Request-Deadline-Ms). Past either limit the client immediately gets an UNKNOWN
+    # verdict with a retry delay instead of queueing, so latency stays bounded in a burst.
+    def __init__(self, wsgi_app, threads, admission_limit, deadline_ms):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="asgi-handler")
+        self.admission_limit = admission_limit
+        self.deadline = deadline_ms / 1000.0
+        self.admitted = 0  # Only touched on the event loop thread
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.executor.shutdown(wait=False)
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if len(body) > MAX_REQUEST_BYTES:
+                await self._send(send, 413, [(b'content-type', b'application/json')], b'{"error": "Request too large"}')
+                return
+            if not message.get('more_body'):
+                break
+
+        loop = asyncio.get_running_loop()
+        if scope['method'] != 'POST' or scope['path'] not in PREDICT_PATHS:
+            status, headers, content = await loop.run_in_executor(self.executor, self._call_wsgi, scope, bytes(body), None)
+            await self._send(send, status, headers, content)
+            return
+
+        if self.admitted >= self.admission_limit:
+            category_stats['Shed (Overloaded)'] += 1
+            await self._send_unknown(send, 'overloaded')
+            return
+        timeout = self.deadline
+        for name, value in scope['headers']:
+            if name == b'x-request-deadline-ms':
+                try:
+                    timeout = min(timeout, max(0.0, float(value) / 1000.0))
+                except ValueError:
+                    pass
+        self.admitted += 1
+        future = loop.run_in_executor(self.executor, self._call_wsgi, scope, bytes(body), time.monotonic() + timeout)
+        # Admission is released when the handler actually finishes, not when we stop waiting
+        future.add_done_callback(self._release)
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            result = None
+        if result is None:
+            category_stats['Shed (Deadline)'] += 1
+            await self._send_unknown(send, 'deadline_exceeded')
+            return
+        await self._send(send, *result)
+
+    def _release(self, future):
+        self.admitted -= 1
+
+    def _call_wsgi(self, scope, body, deadline):
+        # Runs one request through Flask on an executor thread; returns None without
+        # running it when its deadline passed while it waited for a thread
+        if deadline is not None and time.monotonic() > deadline:
+            return None
+        environ = {
+            'REQUEST_METHOD': scope['method'], 'SCRIPT_NAME': '', 'PATH_INFO': scope['path'],
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': scope['server'][0] if scope.get('server') else 'localhost',
+            'SERVER_PORT': str(scope['server'][1]) if scope.get('server') else '80',
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+            'wsgi.version': (1, 0), 'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': BytesIO(body), 'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+            'CONTENT_LENGTH': str(len(body)),
+        }
+        for name, value in scope['headers']:
+            name, value = name.decode('latin-1'), value.decode('latin-1')
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'content-length':
+                key = 'HTTP_' + name.upper().replace('-', '_')
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+        result = self.wsgi_app(environ, start_response)
+        try:
+            content = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], content
+
+    async def _send_unknown(self, send, reason):
+        content = json.dumps({'prediction': 'UNKNOWN', 'error': reason, 'retry_after_ms': SHED_RETRY_AFTER_MS}).encode('utf-8')
+        headers = [(b'content-type', b'application/json'), (b'access-control-allow-origin', b'*'),
+                   (b'retry-after', str(math.ceil(SHED_RETRY_AFTER_MS / 1000)).encode('ascii'))]
+        await self._send(send, 503, headers, content)
+
+    @staticmethod
+    async def _send(send, status, headers, content):
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': content})
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+def load_image_rgb(path):
+    img_bgr = cv2.imread(path, cv2.IMREAD_COLOR)
+    if img_bgr is None:
+        return None
+    return cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
+
+def make_near_duplicate_variants(img_np):
+    # The kinds of copies a CDN serves: downscaled, recompressed, and both
+    height, width = img_np.shape[:2]
+    half = cv2.resize(img_np, (max(width // 2, 1), max(height // 2, 1)), interpolation=cv2.INTER_AREA)
+
+    def recompress(image, quality):
+        ok, encoded = cv2.imencode('.jpg', cv2.cvtColor(image, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, quality])
+        return cv2.cvtColor(cv2.imdecode(encoded, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+
+    return {'half_size': half, 'jpeg_q60': recompress(img_np, 60), 'half_size_jpeg_q75': recompress(half, 75)}
+
+def validate_near_duplicate_cache(image_dir, threshold=DEFAULT_NSFW_THRESHOLD, limit=None):
+    # Indexes every stored image, then looks up resized/recompressed variants of each one
+    # and compares the reused verdict with the model's verdict on the variant itself
+    paths = sorted(os.path.join(image_dir, f) for f in os.listdir(image_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+    if limit:
+        paths = paths[:limit]
+    cache = VerdictCache(len(paths) + 1, float('inf'), near_duplicates=True)
+
+    originals = []
+    for path in paths:
+        img_np = load_image_rgb(path)
+        if img_np is None:
+            continue
+        detections = run_model([img_np], RAW_DETECTION_CONF)[0]
+        pixel_key = cache.pixel_key(img_np)
+        cache.put(pixel_key, None, detections, img_np.shape, dhash(img_np))
+        originals.append((path, img_np, pixel_key))
+
+    report = defaultdict(lambda: {'variants': 0, 'hits': 0, 'wrong_source': 0, 'differed': 0})
+    for path, img_np, pixel_key in originals:
+        for name, variant in make_near_duplicate_variants(img_np).items():
+            stats = report[name]
+            stats['variants'] += 1
+            variant_hash = dhash(variant)
+            matches = cache.phash_tree.search(variant_hash, cache.max_distance) if variant_hash is not None else []
+            if not matches:
+                continue
+            stats['hits'] += 1
+            matched_key = matches[0][1]
+            if matched_key != pixel_key:
+                stats['wrong_source'] += 1
+            reused = [d for d in cache.entries[matched_key][0] if d['confidence'] >= threshold]
+            actual = [d for d in run_model([variant], threshold)[0] if d['confidence'] >= threshold]
+            if check_nsfw(reused, threshold)[0] != check_nsfw(actual, threshold)[0]:
+                stats['differed'] += 1
+
+    print(f"\n=== Near-Duplicate Validation ({len(originals)} images, distance <= {cache.max_distance}, threshold {threshold}) ===")
+    for name, stats in report.items():
+        hit_rate = 100.0 * stats['hits'] / stats['variants'] if stats['variants'] else 0.0
+        differed_rate = 100.0 * stats['differed'] / stats['hits'] if stats['hits'] else 0.0
+        print(f"{name}: hit rate {hit_rate:.1f}% ({stats['hits']}/{stats['variants']}), "
+              f"wrong source {stats['wrong_source']}, verdict differed {differed_rate:.1f}% ({stats['differed']})")
+    print("==========================\n")
+    return dict(report)
+
+def evaluate_cascade(image_dir, limit=None):
+    # Runs the skin-tone pre-filter and the model over a labelled set (images under
+    # nsfw/ and sfw/ subfolders of image_dir, e.g. the archive) and reports, per threshold,
+    # how much still reaches the model and how much the pre-filter would have let through.
+    # Images large enough to be tiled always reach the model, and its verdict on them
+    # includes the tiled pass, as when serving.
+    labelled = []
+    for label in ('nsfw', 'sfw'):
+        folder = os.path.join(image_dir, label)
+        if os.path.isdir(folder):
+            labelled += [(os.path.join(folder, f), label) for f in sorted(os.listdir(folder)) if f.lower().endswith(IMAGE_EXTENSIONS)]
+    if limit:
+        labelled = labelled[:limit]
+
+    samples, prefilter_times, model_times = [], [], []
+    for path, label in labelled:
+        img_np = load_image_rgb(path)
+        if img_np is None:
+            continue
+        start = time.perf_counter()
+        ratio = skin_tone_ratio(img_np)
+        tiled = tile_windows(img_np.shape[0], img_np.shape[1], get_model_input_size()) is not None
+        prefilter_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        detections = run_model([img_np], RAW_DETECTION_CONF)[0]
+        if tiled:
+            job = {'img_np': img_np, 'threshold': min(DEFAULT_NSFW_THRESHOLD, UNSAFE_WORD_THRESHOLD)}
+            detections = refine_with_tiles([job], [detections], [RAW_DETECTION_CONF])[0]
+        model_times.append(time.perf_counter() - start)
+        samples.append((label, ratio, tiled, detections))
+    if not samples:
+        print(f"No images found under {image_dir}/nsfw or {image_dir}/sfw")
+        return None
+
+    report = {'images': len(samples), 'colourless': sum(ratio is None for _, ratio, _, _ in samples),
+              'tiled': sum(tiled for _, _, tiled, _ in samples),
+              'prefilter_mean_ms': 1000 * mean(prefilter_times), 'model_mean_ms': 1000 * mean(model_times)}
+    for threshold in (DEFAULT_NSFW_THRESHOLD, UNSAFE_WORD_THRESHOLD):
+        cutoff = prefilter_cutoff(threshold)
+        skipped = [not tiled and ratio is not None and ratio < cutoff for _, ratio, tiled, _ in samples]
+        labelled_nsfw = [skip for (label, _, _, _), skip in zip(samples, skipped) if label == 'nsfw']
+        model_nsfw = [skip for (_, _, _, detections), skip in zip(samples, skipped) if check_nsfw(detections, threshold)[0]]
+        report[f'threshold_{threshold}'] = {
+            'skin_cutoff': cutoff,
+            'pass_through_rate': 1 - sum(skipped) / len(samples),
+            'label_miss_rate': sum(labelled_nsfw) / len(labelled_nsfw) if labelled_nsfw else None,
+            'model_miss_rate': sum(model_nsfw) / len(model_nsfw) if model_nsfw else None,
+            'missed_nsfw_labelled': sum(labelled_nsfw),
+            'missed_model_positives': sum(model_nsfw),
+        }
+
+    print(f"\n=== Pre-filter Cascade Evaluation ({len(samples)} images) ===")
+    print(json.dumps(report, indent=2))
+    print("==========================\n")
+    return report
+
+def compare_backends(image_dir, engine, quantize_int8=False, threshold=DEFAULT_NSFW_THRESHOLD, limit=None, batch_size=8):
+    # Runs the PyTorch path and an ONNX backend on the same images and reports
+    # latency (single image and batched) and how closely their detections agree
+    paths = sorted(os.path.join(image_dir, f) for f in os.listdir(image_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+    if limit:
+        paths = paths[:limit]
+    images = [img for img in (load_image_rgb(path) for path in paths) if img is not None]
+    if not images:
+        print(f"No images found in {image_dir}")
+        return None
+    backend = load_onnx_backend(os.path.join(ERAX_MODEL_LOCAL_DIR, ERAX_MODEL_FILENAME), engine, quantize_int8)
+    runners = {'pytorch': run_ultralytics_model, engine: backend.predict}
+
+    report = {}
+    outputs = {}
+    for name, runner in runners.items():
+        runner(images[:1], RAW_DETECTION_CONF)  # warm-up
+        single_times, outputs[name] = [], []
+        for img_np in images:
+            start = time.perf_counter()
+            outputs[name].append(runner([img_np], RAW_DETECTION_CONF)[0])
+            single_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        for i in range(0, len(images), batch_size):
+            runner(images[i:i + batch_size], RAW_DETECTION_CONF)
+        batched_per_image = (time.perf_counter() - start) / len(images)
+        single_times.sort()
+        report[name] = {
+            'mean_ms': 1000 * mean(single_times),
+            'p50_ms': 1000 * single_times[len(single_times) // 2],
+            'p95_ms': 1000 * single_times[min(len(single_times) - 1, int(len(single_times) * 0.95))],
+            f'batched_{batch_size}_ms_per_image': 1000 * batched_per_image,
+        }
+
+    verdict_agreement, class_agreement, confidence_errors = 0, 0, []
+    for reference, candidate in zip(outputs['pytorch'], outputs[engine]):
+        ref_nsfw, ref_conf, ref_class = check_nsfw([d for d in reference if d['confidence'] >= threshold], threshold)
+        new_nsfw, new_conf, new_class = check_nsfw([d for d in candidate if d['confidence'] >= threshold], threshold)
+        verdict_agreement += ref_nsfw == new_nsfw
+        class_agreement += ref_class == new_class
+        top_ref = max((d['confidence'] for d in reference if d['class'] in NSFW_CLASSES), default=0.0)
+        top_new = max((d['confidence'] for d in candidate if d['class'] in NSFW_CLASSES), default=0.0)
+        confidence_errors.append(abs(top_ref - top_new))
+    report['accuracy'] = {
+        'images': len(images),
+        'verdict_agreement': verdict_agreement / len(images),
+        'class_agreement': class_agreement / len(images),
+        'mean_abs_top_nsfw_confidence_diff': mean(confidence_errors),
+        'max_abs_top_nsfw_confidence_diff': max(confidence_errors),
+    }
+
+    print(f"\n=== Backend Comparison ({len(images)} images, threshold {threshold}) ===")
+    print(json.dumps(report, indent=2))
+    print("==========================\n")
+    return report
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="EraX NSFW detection server")
+    parser.add_argument('--validate-phash', metavar='DIR',
+                        help="Measure near-duplicate hit rate and verdict disagreement on the images in DIR, then exit")
+    parser.add_argument('--compare-backends', metavar='DIR',
+                        help="Benchmark the PyTorch path against the --engine backend on the images in DIR, then exit")
+    parser.add_argument('--evaluate-cascade', metavar='DIR',
+                        help="Report the skin-tone pre-filter's pass-through and miss rates on DIR/nsfw and DIR/sfw, then exit")
+    parser.add_argument('--engine', choices=['onnxruntime', 'openvino'], default='onnxruntime',
+                        help="ONNX engine used by --compare-backends")
+    parser.add_argument('--int8', action='store_true', help="Use the INT8-quantized export with --compare-backends")
+    parser.add_argument('--asgi', action='store_true',
+                        help="Serve through uvicorn with admission control and request deadlines instead of Flask's server")
+    parser.add_argument('--limit', type=int, default=None, help="Max images to use for offline validation")
+    args = parser.parse_args()
+
     def signal_handler(sig, frame):
         print("\nShutting down server...")
         print_statistics()
@@ -334,8 +2611,55 @@ if __name__ == '__main__':
     
     load_erax_nsfw_model()
     
+    if args.compare_backends:
+        compare_backends(args.compare_backends, args.engine, args.int8, limit=args.limit)
+        sys.exit(0)
+    
+    if args.evaluate_cascade:
+        evaluate_cascade(args.evaluate_cascade, limit=args.limit)
+        sys.exit(0)
+    
+    if args.validate_phash:
+        validate_near_duplicate_cache(args.validate_phash, limit=args.limit)
+        sys.exit(0)
+    
+    if ENABLE_VERDICT_CACHE:
+        if ENABLE_VERDICT_STORE:
+            verdict_store = VerdictStore(VERDICT_STORE_PATH, ERAX_MODEL_FILENAME)
+            atexit.register(verdict_store.close)
+        verdict_cache = VerdictCache(VERDICT_CACHE_MAX_ENTRIES, VERDICT_CACHE_TTL_SECONDS,
+                                     near_duplicates=ENABLE_NEAR_DUPLICATE_CACHE, store=verdict_store)
+        print(f"Verdict cache ENABLED (up to {VERDICT_CACHE_MAX_ENTRIES} images, TTL {VERDICT_CACHE_TTL_SECONDS}s).")
+        if verdict_store is not None:
+            warm_start = time.time()
+            warmed = verdict_cache.warm(VERDICT_STORE_WARM_ENTRIES)
+            print(f"Verdict store at {VERDICT_STORE_PATH}: warmed {warmed} verdicts in {time.time() - warm_start:.2f}s.")
+        if ENABLE_NEAR_DUPLICATE_CACHE:
+            print(f"Near-duplicate matching ENABLED (dHash distance <= {PHASH_MAX_DISTANCE}).")
+    
+    archiver = ImageArchiver(FULL_DIR, ARCHIVE_QUEUE_SIZE, ARCHIVE_FULL_POLICY)
+    atexit.register(archiver.close)
+    
+    if INFERENCE_WORKERS > 0:
+        threads = WORKER_THREADS or max(1, (os.cpu_count() or 1) // INFERENCE_WORKERS)
+        slots = max(INFERENCE_WORKERS * BATCH_MAX_SIZE * 2, PREDICT_BATCH_MAX_ITEMS)
+        worker_pool = InferenceWorkerPool(INFERENCE_WORKERS, threads, slots, WORKER_SLOT_BYTES)
+        atexit.register(worker_pool.close)
+        print(f"Inference worker pool ENABLED ({INFERENCE_WORKERS} processes x {threads} threads, {slots} shared-memory slots).")
+    
+    if ENABLE_MICRO_BATCHING:
+        batcher = MicroBatcher(BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+        print(f"Micro-batching ENABLED (up to {BATCH_MAX_SIZE} images or {BATCH_MAX_WAIT_MS} ms per batch).")
+    
     print("Starting Flask server...")
     print(f"Domain-specific rules are {'ENABLED' if ENABLE_DOMAIN_RULES else 'DISABLED'}.")
     print(f"Unsafe word check is {'ENABLED' if ENABLE_UNSAFE_WORD_CHECK else 'DISABLED'}.")
+    print(f"Skin-tone pre-filter is {'ENABLED' if ENABLE_SAFE_PREFILTER else 'DISABLED'}.")
     print("Press Ctrl+C to stop the server and see statistics")
-    app.run(host='0.0.0.0', port=5000)
+    if args.asgi:
+        import uvicorn
+        asgi_bridge = AsgiBridge(app, ASGI_THREADS, ADMISSION_QUEUE_SIZE, REQUEST_DEADLINE_MS)
+        print(f"ASGI mode ({ASGI_THREADS} handler threads, {ADMISSION_QUEUE_SIZE} admitted predictions, {REQUEST_DEADLINE_MS} ms deadline).")
+        uvicorn.run(asgi_bridge, host='0.0.0.0', port=5000, log_level='warning')
+    else:
+        app.run(host='0.0.0.0', port=5000, threaded=True)
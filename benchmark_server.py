@@ -0,0 +1,260 @@
+import argparse
+import base64
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+# Replays recorded request bodies (RECORD_REQUESTS_PATH in the server) or a folder of
+# images against the server and reports throughput, latency percentiles, a per-stage
+# breakdown and peak memory as JSON, so runs with different settings can be compared.
+#
+# Worker processes re-import the server script by path, which only works when it runs as
+# __main__, so benchmark INFERENCE_WORKERS settings with --target url.
+#
+# Targets:
+#   app      - the Flask app in this process, through its test client (full request path)
+#   url      - a running server over HTTP (no stage breakdown)
+#   pipeline - prepare_prediction / resolve_detections / finish_prediction called directly
+#   model    - one forward pass per image, nothing else
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Erax_AI_model_1.1.py")
+STAGES = ['prepare_prediction', 'resolve_detections', 'run_model', 'finish_prediction']
+
+def load_server():
+    spec = importlib.util.spec_from_file_location("erax_server", SERVER_SCRIPT)
+    server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server)
+    return server
+
+def load_bodies(requests_path=None, image_dir=None, meta_path=None):
+    # Request bodies as /predict takes them. Image folders get default page context,
+    # overridden per file name by the optional meta JSON ({"name.jpg": {...fields}})
+    if requests_path:
+        with open(requests_path, encoding='utf-8') as f:
+            bodies = [json.loads(line) for line in f if line.strip()]
+        for body in bodies:
+            body.pop('recorded_at', None)
+            body.pop('session_id', None)
+        return bodies
+
+    meta = {}
+    if meta_path:
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+    bodies = []
+    for name in sorted(os.listdir(image_dir)):
+        extension = os.path.splitext(name)[1].lower().lstrip('.')
+        if extension not in ('jpg', 'jpeg', 'png', 'webp', 'bmp', 'gif'):
+            continue
+        with open(os.path.join(image_dir, name), 'rb') as f:
+            encoded = base64.b64encode(f.read()).decode('ascii')
+        mime = 'jpeg' if extension == 'jpg' else extension
+        body = {'source_url': 'benchmark', 'page_title': '', 'alt_text': '', 'caption': ''}
+        body.update(meta.get(name, {}))
+        body['base64_image'] = f"data:image/{mime};base64,{encoded}"
+        bodies.append(body)
+    return bodies
+
+class StageTimer:
+    # Wraps server functions so every call adds its wall time to a per-stage total
+    def __init__(self, server):
+        self.totals = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.lock = threading.Lock()
+        for name in STAGES:
+            setattr(server, name, self._wrap(name, getattr(server, name)))
+
+    def _wrap(self, name, function):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.totals[name] += elapsed
+                    self.calls[name] += 1
+        return timed
+
+    def report(self):
+        return {name: {'calls': self.calls[name], 'total_s': self.totals[name],
+                       'mean_ms': 1000 * self.totals[name] / self.calls[name]}
+                for name in STAGES if self.calls[name]}
+
+def make_sender(target, server, url):
+    if target == 'app':
+        client = server.app.test_client()
+        return lambda body: client.post('/predict', json=body).get_json()
+    if target == 'url':
+        def send(body):
+            request = urllib.request.Request(f"{url.rstrip('/')}/predict", data=json.dumps(body).encode('utf-8'),
+                                             headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())
+        return send
+    if target == 'pipeline':
+        def send(body):
+            start = time.time()
+            job = server.prepare_prediction(body)
+            try:
+                detections = server.resolve_detections([job])[0]
+                if isinstance(detections, Exception):
+                    raise detections
+                return server.finish_prediction(job, detections, start)
+            finally:
+                server.decode_buffers.release(job['img_np'])
+        return send
+    if target == 'model':
+        def send(body):
+            img_np = server.process_base64_image(body['base64_image'])[0]
+            return server.run_model([img_np], server.RAW_DETECTION_CONF)
+        return send
+    raise ValueError(f"Unknown target: {target}")
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def run_benchmark(send, bodies, concurrency, repeat):
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def one(body):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            result = send(body)
+            failed = isinstance(result, dict) and 'error' in result
+        except Exception:
+            failed = True
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            errors += failed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, bodies * repeat))
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies), 'errors': errors, 'wall_s': wall,
+        'throughput_rps': len(latencies) / wall if wall else 0.0,
+        'mean_ms': 1000 * sum(latencies) / len(latencies),
+        'p50_ms': 1000 * percentile(latencies, 0.50),
+        'p95_ms': 1000 * percentile(latencies, 0.95),
+        'p99_ms': 1000 * percentile(latencies, 0.99),
+        'max_ms': 1000 * latencies[-1],
+    }
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def configure_server(server, args):
+    # Mirrors the server's __main__ setup for the parts that matter to throughput
+    server.INFERENCE_BACKEND = args.backend
+    server.ONNX_QUANTIZE_INT8 = args.int8
+    server.ENABLE_SAFE_PREFILTER = not args.no_prefilter
+    server.ENABLE_TILED_INFERENCE = not args.no_tiling
+    server.ENABLE_ADAPTIVE_DOMAINS = not args.no_adaptive_domains
+    server.load_erax_nsfw_model()
+    if not args.no_cache:
+        # In memory only, so every run starts cold and repeats measure the cache itself
+        server.verdict_cache = server.VerdictCache(server.VERDICT_CACHE_MAX_ENTRIES, server.VERDICT_CACHE_TTL_SECONDS,
+                                                   near_duplicates=server.ENABLE_NEAR_DUPLICATE_CACHE)
+    if not args.no_batching:
+        server.batcher = server.MicroBatcher(server.BATCH_MAX_SIZE, server.BATCH_MAX_WAIT_MS)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay benchmark for the EraX NSFW detection server")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--requests', metavar='FILE', help="JSONL of recorded request bodies")
+    source.add_argument('--images', metavar='DIR', help="Folder of images to send as request bodies")
+    parser.add_argument('--meta', metavar='FILE', help="JSON of per-file request fields for --images")
+    parser.add_argument('--target', choices=['app', 'url', 'pipeline', 'model'], default='app')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="Server address for --target url")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=1, help="Send every body this many times")
+    parser.add_argument('--warmup', type=int, default=3, help="Requests sent before timing starts")
+    parser.add_argument('--backend', choices=['ultralytics', 'onnxruntime', 'openvino'], default='ultralytics')
+    parser.add_argument('--int8', action='store_true', help="Use the INT8-quantized ONNX export")
+    parser.add_argument('--no-batching', action='store_true')
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--no-prefilter', action='store_true')
+    parser.add_argument('--no-tiling', action='store_true')
+    parser.add_argument('--no-adaptive-domains', action='store_true',
+                        help="Ignore domain history; every --images body shares one source_url, so it soon skips the model")
+    parser.add_argument('--trace-memory', action='store_true', help="Also report the Python heap peak (slower)")
+    parser.add_argument('--label', default='', help="Free-form name stored with the results")
+    parser.add_argument('--output', metavar='FILE', help="Write the JSON report here as well as to stdout")
+    args = parser.parse_args()
+
+    bodies = load_bodies(args.requests, args.images, args.meta)
+    if not bodies:
+        print("No request bodies to replay")
+        sys.exit(1)
+
+    server = None
+    timer = None
+    if args.target != 'url':
+        server = load_server()
+        server.archiver = None  # Never write benchmark images into the archive
+        configure_server(server, args)
+        timer = StageTimer(server)
+    send = make_sender(args.target, server, args.url)
+
+    for body in bodies[:args.warmup]:
+        send(body)
+    if timer is not None:
+        timer.totals.clear()
+        timer.calls.clear()
+    if server is not None and server.verdict_cache is not None:
+        # Warm-up requests must not turn the timed ones into cache hits
+        server.verdict_cache = server.VerdictCache(server.VERDICT_CACHE_MAX_ENTRIES, server.VERDICT_CACHE_TTL_SECONDS,
+                                                   near_duplicates=server.ENABLE_NEAR_DUPLICATE_CACHE)
+    if server is not None:
+        # Nor shift their thresholds or fast path through domain history
+        server.domain_stats = server.DomainStatsStore(server.DOMAIN_STATS_MAX, server.DOMAIN_HISTOGRAM_BINS)
+
+    if args.trace_memory:
+        tracemalloc.start()
+    results = run_benchmark(send, bodies, args.concurrency, args.repeat)
+    report = {
+        'label': args.label, 'target': args.target, 'bodies': len(bodies), 'concurrency': args.concurrency,
+        'settings': {key: getattr(args, key) for key in ('backend', 'int8', 'no_batching', 'no_cache',
+                                                          'no_prefilter', 'no_tiling', 'no_adaptive_domains', 'repeat')},
+        'latency': results,
+        'stages': timer.report() if timer is not None else None,
+        'memory': {'peak_rss_mb': peak_rss_mb()},
+    }
+    if args.trace_memory:
+        report['memory']['python_heap_peak_mb'] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+    if server is not None:
+        if server.verdict_cache is not None:
+            cache = server.verdict_cache
+            report['cache'] = {'raw_hits': cache.raw_hits, 'pixel_hits': cache.pixel_hits,
+                               'near_hits': cache.near_hits, 'misses': cache.misses}
+        if server.batcher is not None:
+            report['batch_sizes'] = dict(server.batcher.batch_size_counts)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + "\n")
@@ -0,0 +1,441 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark_server import load_server
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Only needed for --format parquet
+    pa = pq = None
+
+# Re-scores stored images offline, e.g. the server's archive after a model or threshold
+# change, without going through HTTP. Sources are streamed one image at a time:
+#   directory    - every image file below it
+#   .tar/.tgz    - read as a stream, so compressed archives are never unpacked to disk
+#   .zip         - members in archive order
+#   .txt/.jsonl  - a manifest of image paths (relative to the manifest), one per line,
+#                  as plain text or as {"path": ...} objects
+#
+# Images are decoded in a thread pool while the previous batch is in the model, and each
+# batch's results are appended to the output before the next one starts. Rerunning the
+# same command skips every key already in the output, so an interrupted scan resumes
+# where it stopped; keys that ended in an ERROR row are tried again, and the newest row
+# for a key is the one that counts. Keys are file paths, or "<archive>::<member>".
+#
+# With --processes N the model runs in N scan processes, like the server's
+# INFERENCE_WORKERS, each with its own model, decode threads and share of the cores. This
+# process reads the sources and writes the output; an image is sent to the scan processes
+# as its path, or as its bytes when it comes out of an archive. If a scan process dies
+# the scan stops, and rerunning it resumes from what was written.
+#
+# Results keep the raw detections (at the server's RAW_DETECTION_CONF) next to the verdict
+# at --threshold, so a later threshold change can be applied without another scan.
+
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+MANIFEST_SUFFIXES = ('.txt', '.jsonl')
+PROGRESS_INTERVAL_SECONDS = 10
+PARQUET_FLUSH_SECONDS = 30  # A Parquet part is written at least this often while rows come in
+
+def is_image_name(name, extensions):
+    return name.lower().endswith(extensions)
+
+# Every source yields (key, source) pairs, where source is a file path or the image bytes
+
+def iter_directory(path, extensions):
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if is_image_name(name, extensions):
+                file_path = os.path.join(root, name)
+                yield file_path, file_path
+
+def iter_tar(path, extensions):
+    with tarfile.open(path, 'r|*') as archive:
+        for member in archive:
+            if member.isfile() and is_image_name(member.name, extensions):
+                yield f"{path}::{member.name}", archive.extractfile(member).read()
+
+def iter_zip(path, extensions):
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            if not info.is_dir() and is_image_name(info.filename, extensions):
+                yield f"{path}::{info.filename}", archive.read(info)
+
+def iter_manifest(path):
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)['path'] if line.startswith('{') else line
+            file_path = os.path.join(base_dir, entry)
+            yield file_path, file_path
+
+def iter_sources(inputs, extensions):
+    for path in inputs:
+        lower = path.lower()
+        if os.path.isdir(path):
+            yield from iter_directory(path, extensions)
+        elif lower.endswith(ARCHIVE_SUFFIXES):
+            yield from iter_tar(path, extensions)
+        elif lower.endswith('.zip'):
+            yield from iter_zip(path, extensions)
+        elif lower.endswith(MANIFEST_SUFFIXES):
+            yield from iter_manifest(path)
+        elif is_image_name(path, extensions):
+            yield path, path
+        else:
+            print(f"Skipping {path}: not a directory, archive, manifest or image", file=sys.stderr)
+
+class JsonlWriter:
+    # Appends one line per result; a line cut short by an interruption is dropped on resume
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, 'rb+') as f:
+                content = f.read()
+                complete = content[:content.rfind(b'\n') + 1]
+                if len(complete) != len(content):
+                    f.truncate(len(complete))
+            for line in complete.decode('utf-8').splitlines():
+                if line.strip():
+                    row = json.loads(line)
+                    if row['prediction'] != 'ERROR':
+                        self.done.add(row['key'])
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def write(self, rows):
+        for row in rows:
+            self.file.write(json.dumps(row) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class ParquetWriter:
+    # A directory of part files, since a Parquet file cannot be appended to once closed.
+    # A part is written every rows_per_part rows or PARQUET_FLUSH_SECONDS, whichever
+    # comes first, which bounds what a hard kill can lose.
+    def __init__(self, path, rows_per_part):
+        self.path = path
+        self.rows_per_part = rows_per_part
+        self.pending = []
+        self.last_flush = time.monotonic()
+        self.done = set()
+        os.makedirs(path, exist_ok=True)
+        parts = sorted(name for name in os.listdir(path) if name.endswith('.parquet'))
+        for name in parts:
+            table = pq.read_table(os.path.join(path, name), columns=['key', 'prediction'])
+            self.done.update(key for key, prediction in zip(table.column('key').to_pylist(),
+                                                            table.column('prediction').to_pylist())
+                             if prediction != 'ERROR')
+        self.next_part = len(parts)
+
+    def write(self, rows):
+        self.pending.extend(rows)
+        if len(self.pending) >= self.rows_per_part or time.monotonic() - self.last_flush >= PARQUET_FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+        # Nested values are stored as JSON strings so every part has the same flat schema
+        table = pa.Table.from_pylist([
+            {name: json.dumps(value) if isinstance(value, (list, dict)) else value for name, value in row.items()}
+            for row in self.pending
+        ])
+        # Written under a temporary name first so a part is either complete or absent
+        final_path = os.path.join(self.path, f"part-{self.next_part:05d}.parquet")
+        pq.write_table(table, final_path + ".tmp")
+        os.replace(final_path + ".tmp", final_path)
+        self.next_part += 1
+        self.pending = []
+
+    def close(self):
+        self.flush()
+
+class ResultSink:
+    # Hands finished rows to the writer and keeps the counts and progress line
+    def __init__(self, writer):
+        self.writer = writer
+        self.counts = defaultdict(int)
+        self.start = self.last_report = time.perf_counter()
+
+    def scanned(self):
+        return sum(self.counts[p] for p in ('NSFW', 'SFW', 'ERROR'))
+
+    def write(self, rows):
+        self.writer.write(rows)
+        for row in rows:
+            self.counts[row['prediction']] += 1
+        now = time.perf_counter()
+        if now - self.last_report >= PROGRESS_INTERVAL_SECONDS:
+            scanned = self.scanned()
+            print(f"{scanned} scanned ({scanned / (now - self.start):.1f}/s), {self.counts['NSFW']} NSFW, "
+                  f"{self.counts['ERROR']} errors, {self.counts['skipped']} already done", file=sys.stderr)
+            self.last_report = now
+
+    def report(self):
+        wall = time.perf_counter() - self.start
+        scanned = self.scanned()
+        return {'scanned': scanned, 'nsfw': self.counts['NSFW'], 'sfw': self.counts['SFW'], 'errors': self.counts['ERROR'],
+                'skipped': self.counts['skipped'], 'wall_s': wall, 'throughput_ips': scanned / wall if wall else 0.0}
+
+def pending_sources(sources, sink, limit):
+    # Sources not already in the output, up to limit of them
+    taken = 0
+    for key, source in sources:
+        if key in sink.writer.done:
+            sink.counts['skipped'] += 1
+            continue
+        if limit is not None and taken >= limit:
+            return
+        taken += 1
+        yield key, source
+
+def decode(server, key, source):
+    try:
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                source = f.read()
+        img_np, shape = server.decode_image(source)
+        return key, img_np, shape, None
+    except Exception as e:
+        return key, None, None, e
+
+def scan_batch(server, decoded, threshold, prefilter):
+    # Verdict rows for one batch of decoded images, in order
+    rows = [None] * len(decoded)
+    jobs, indices = [], []
+    for index, (key, img_np, shape, error) in enumerate(decoded):
+        row = {'key': key, 'prediction': None, 'confidence': None, 'class': None, 'regions': None,
+               'detections': None, 'prefiltered': False, 'error': None,
+               'height': shape[0] if shape else None, 'width': shape[1] if shape else None,
+               'threshold': threshold, 'model': server.ERAX_MODEL_FILENAME, 'scanned_at': time.time()}
+        rows[index] = row
+        if error is not None:
+            row.update(prediction='ERROR', error=str(error))
+        elif prefilter and server.is_confidently_safe(img_np, threshold):
+            row.update(prediction='SFW', confidence=0.0, prefiltered=True, detections=[])
+        else:
+            jobs.append({'img_np': img_np, 'threshold': threshold})
+            indices.append(index)
+
+    thresholds = [server.RAW_DETECTION_CONF] * len(jobs)
+    try:
+        outcomes = server.detect_many([job['img_np'] for job in jobs], thresholds)
+        # Tiles go through at most one batch's worth at a time, like the global pass
+        outcomes = server.refine_with_tiles(jobs, outcomes, thresholds, chunk_size=len(decoded))
+    except Exception as e:
+        # A failed forward pass fails its batch only; its rows record the error
+        outcomes = [e] * len(jobs)
+    for index, outcome in zip(indices, outcomes):
+        row = rows[index]
+        if isinstance(outcome, Exception):
+            row.update(prediction='ERROR', error=str(outcome))
+            continue
+        is_nsfw, confidence, detected_class = server.check_nsfw(outcome, threshold)
+        row.update(prediction='NSFW' if is_nsfw else 'SFW', confidence=float(confidence), detections=outcome)
+        if is_nsfw:
+            row.update({'class': detected_class, 'regions': server.detection_regions(outcome, threshold)})
+
+    for _, img_np, _, _ in decoded:
+        server.decode_buffers.release(img_np)
+    return rows
+
+def run_scan(server, items, sink, args):
+    # Decodes keep running up to a few batches ahead of the model, in source order
+    ahead = deque()
+    batch = []
+
+    def flush():
+        sink.write(scan_batch(server, batch, args.threshold, args.prefilter))
+        batch.clear()
+
+    with ThreadPoolExecutor(max_workers=args.decode_threads) as executor:
+        for key, source in items:
+            ahead.append(executor.submit(decode, server, key, source))
+            while len(ahead) > args.batch_size * args.prefetch_batches:
+                batch.append(ahead.popleft().result())
+                if len(batch) >= args.batch_size:
+                    flush()
+        while ahead:
+            batch.append(ahead.popleft().result())
+            if len(batch) >= args.batch_size:
+                flush()
+        if batch:
+            flush()
+
+def configure_server(server, args, threads=0):
+    # Batches are formed here, so the server's micro-batcher and cache stay off
+    server.INFERENCE_BACKEND = args.backend
+    server.ONNX_QUANTIZE_INT8 = args.int8
+    server.ENABLE_TILED_INFERENCE = not args.no_tiling
+    if threads:
+        server.torch.set_num_threads(threads)
+        server.INFERENCE_INTRA_OP_THREADS = threads
+    server.load_erax_nsfw_model()
+
+class QueueSink:
+    # Stands in for ResultSink inside a scan process: rows go back to the parent to write
+    def __init__(self, result_queue):
+        self.result_queue = result_queue
+
+    def write(self, rows):
+        self.result_queue.put(rows)
+
+def scan_process_main(args, threads, task_queue, result_queue):
+    # Entry point of one --processes scan process; a None task ends it
+    def items():
+        while True:
+            item = task_queue.get()
+            if item is None:
+                return
+            yield item
+
+    server = load_server()
+    server.cv2.setNumThreads(1)
+    configure_server(server, args, threads)
+    try:
+        run_scan(server, items(), QueueSink(result_queue), args)
+    except KeyboardInterrupt:
+        return  # The parent reports the interruption
+    result_queue.put(None)
+
+def run_sharded(items, sink, args):
+    # Feeds the scan processes from this process and writes what they send back
+    context = multiprocessing.get_context('spawn')
+    threads = max(1, (os.cpu_count() or 1) // args.processes)
+    task_queue = context.Queue(maxsize=args.processes * args.batch_size * args.prefetch_batches)
+    result_queue = context.Queue()
+    workers = [context.Process(target=scan_process_main, name=f"scan-{index}", daemon=True,
+                               args=(args, threads, task_queue, result_queue))
+               for index in range(args.processes)]
+    for worker in workers:
+        worker.start()
+    stop = threading.Event()  # Set when a scan process died or this process is giving up
+
+    def collect():
+        finished = 0
+        while finished < len(workers) and not stop.is_set():
+            try:
+                rows = result_queue.get(timeout=1.0)
+            except queue.Empty:
+                if any(worker.exitcode not in (None, 0) for worker in workers):
+                    stop.set()
+                continue
+            if rows is None:
+                finished += 1
+                continue
+            try:
+                sink.write(rows)
+            except Exception as e:
+                print(f"Writing results failed: {e}", file=sys.stderr)
+                stop.set()
+
+    def feed(item):
+        # A bounded put that gives up once the scan cannot finish
+        while not stop.is_set():
+            try:
+                task_queue.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                continue
+        raise RuntimeError("A scan process exited unexpectedly; rerun the same command to resume")
+
+    collector = threading.Thread(target=collect, name="scan-results")
+    collector.start()
+    try:
+        for item in items:
+            feed(item)
+        for _ in workers:
+            feed(None)
+        collector.join()
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        collector.join()
+        for worker in workers:
+            if stop.is_set():
+                worker.terminate()
+            worker.join()
+    if stop.is_set():
+        raise RuntimeError("A scan process exited unexpectedly; rerun the same command to resume")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline bulk scan of images with the EraX NSFW detector")
+    parser.add_argument('inputs', nargs='*', help="Directories, tar/zip archives, manifests or image files")
+    parser.add_argument('--archive', action='store_true',
+                        help="Also scan the server's archive (images/original and thumbnails/original under FULL_DIR)")
+    parser.add_argument('--output', required=True, metavar='PATH',
+                        help="JSONL file, or directory of part files with --format parquet; existing results are skipped")
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], default='jsonl')
+    parser.add_argument('--threshold', type=float, default=None, help="Verdict threshold (default DEFAULT_NSFW_THRESHOLD)")
+    parser.add_argument('--batch-size', type=int, default=None, help="Images per forward pass (default BATCH_MAX_SIZE)")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="Scan processes, each with its own model (default INFERENCE_WORKERS, at least 1)")
+    parser.add_argument('--decode-threads', type=int, default=None, help="Decode threads per process (default: its share of the cores)")
+    parser.add_argument('--prefetch-batches', type=int, default=4, help="Batches decoded ahead of the model")
+    parser.add_argument('--parquet-rows', type=int, default=1000, help="Max rows per Parquet part file")
+    parser.add_argument('--prefilter', action='store_true', help="Let the skin-tone pre-filter skip the model")
+    parser.add_argument('--backend', choices=['ultralytics', 'onnxruntime', 'openvino'], default='ultralytics')
+    parser.add_argument('--int8', action='store_true', help="Use the INT8-quantized ONNX export")
+    parser.add_argument('--no-tiling', action='store_true')
+    parser.add_argument('--limit', type=int, default=None, help="Stop after this many new images")
+    args = parser.parse_args()
+
+    server = load_server()
+    inputs = list(args.inputs)
+    if args.archive:
+        inputs += [os.path.join(server.FULL_DIR, category, "original") for category in ('images', 'thumbnails')]
+    if not inputs:
+        parser.error("nothing to scan: give inputs or --archive")
+    if args.format == 'parquet' and pq is None:
+        parser.error("--format parquet needs pyarrow (pip install pyarrow)")
+    args.threshold = server.DEFAULT_NSFW_THRESHOLD if args.threshold is None else args.threshold
+    args.batch_size = args.batch_size or server.BATCH_MAX_SIZE
+    args.processes = max(1, args.processes or server.INFERENCE_WORKERS)
+    args.decode_threads = args.decode_threads or max(2, (os.cpu_count() or 4) // args.processes)
+
+    if args.format == 'parquet':
+        writer = ParquetWriter(args.output, args.parquet_rows)
+    else:
+        writer = JsonlWriter(args.output)
+    if writer.done:
+        print(f"Resuming: {len(writer.done)} images already in {args.output}", file=sys.stderr)
+
+    sink = ResultSink(writer)
+    items = pending_sources(iter_sources(inputs, server.IMAGE_EXTENSIONS + ('.gif',)), sink, args.limit)
+    try:
+        if args.processes > 1:
+            run_sharded(items, sink, args)
+        else:
+            configure_server(server, args)
+            run_scan(server, items, sink, args)
+    except KeyboardInterrupt:
+        print("Interrupted; rerun the same command to resume", file=sys.stderr)
+        sys.exit(130)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        writer.close()
+    report = sink.report()
+    report['processes'] = args.processes
+    report['output'] = args.output
+    print(json.dumps(report, indent=2))